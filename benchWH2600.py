@@ -0,0 +1,346 @@
+#!/usr/bin/python
+
+'''
+    Load test for the WH2600 Interceptor.
+
+    Runs the real request handler of interceptWH2600.py against local stand-ins for Domoticz,
+    Weather Underground and, with --sinks, an MQTT broker and InfluxDB over HTTP and UDP, feeds it
+    generated or replayed WH2600 reports and prints handler latency percentiles, throughput,
+    upstream call counts and memory growth.
+
+    Copyright (C) 2017  Allan Gam.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    https://github.com/allan-gam
+'''
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+from SocketServer import ThreadingTCPServer, UDPServer, StreamRequestHandler, DatagramRequestHandler
+import json, urlparse, urllib, urllib2
+import os, getopt, sys, shutil, tempfile
+import threading, time, random, collections, gc
+import interceptWH2600 as wh
+
+SAMPLE_FILE = sys.path[0] + '/sample_data.txt'
+CONFIG_FILE = sys.path[0] + '/example_config.json'
+
+# Behaviour of the stand-in servers, changed by the command line options
+upstreamLatency = {'domoticz': 0.0, 'wu': 0.0, 'influxdb': 0.0}
+failureRate = 0.0
+upstreamCalls = collections.Counter()
+upstreamCallsLock = threading.Lock()
+handlerLatencies = []
+handlerLatenciesLock = threading.Lock()
+
+
+#This class stands in for both Domoticz (/json.htm) and the WU update servers
+class fakeUpstreamHandler(BaseHTTPRequestHandler):
+
+	def do_GET(self):
+		url = urlparse.urlparse(self.path)
+		qs = dict(urlparse.parse_qsl(url.query))
+		if url.path == '/json.htm':
+			kind = 'domoticz'
+			call = 'domoticz ' + qs.get('type', '') + ('/' + qs['param'] if 'param' in qs else '')
+		else:
+			kind = 'wu'
+			call = 'wu ' + ('replay' if url.path.startswith('/replay') else 'rapid fire')
+			# The wind window added in config.json must reach WU like the built in ones
+			if 'windspdmph_avg60min' not in qs: call += ' without the 60min window'
+		time.sleep(upstreamLatency[kind])
+		failed = random.random() < failureRate
+		with upstreamCallsLock:
+			upstreamCalls[call + (' (failed)' if failed else '')] += 1
+		if failed:
+			self.send_response(503)
+			self.end_headers()
+			return
+		if kind == 'wu':
+			body = 'success\n'
+		elif qs.get('type') == 'devices':
+			body = json.dumps({'status': 'OK', 'result': [fakeDevice(d['domoticzIdx']) \
+					for d in wh.cfg['domoticz']['devices']['device']]})
+		else:
+			body = json.dumps({'status': 'OK'})
+		self.send_response(200)
+		self.send_header('Content-type', 'text/plain')
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_POST(self):
+		# InfluxDB /write, one reading per line
+		lines = self.rfile.read(int(self.headers.getheader('Content-Length', 0))).splitlines()
+		time.sleep(upstreamLatency['influxdb'])
+		failed = random.random() < failureRate
+		countCall('influxdb http write' + (' (failed)' if failed else ''))
+		if not failed: countCall('influxdb http lines', len(lines))
+		self.send_response(503 if failed else 204)
+		self.end_headers()
+
+	def log_message(self, format, *args):
+		return # Quiet please
+
+#This class stands in for the InfluxDB UDP listener
+class fakeInfluxUDPHandler(DatagramRequestHandler):
+
+	def handle(self):
+		countCall('influxdb udp datagrams')
+		countCall('influxdb udp lines', len(self.rfile.read().splitlines()))
+
+#This class stands in for an MQTT broker, it accepts any client and counts what is published at QoS 0 and 1
+class fakeMQTTHandler(StreamRequestHandler):
+
+	def handle(self):
+		while True:
+			header = self.rfile.read(1)
+			if not header: return
+			length, multiplier = 0, 1
+			while True:
+				digit = ord(self.rfile.read(1))
+				length += (digit & 127) * multiplier
+				multiplier *= 128
+				if digit < 128: break
+			body = self.rfile.read(length)
+			kind = ord(header) >> 4
+			if kind == 1: # CONNECT -> CONNACK
+				self.wfile.write('\x20\x02\x00\x00')
+			elif kind == 3: # PUBLISH, a PUBACK for QoS 1
+				countCall('mqtt publish')
+				if ord(header) & 6:
+					topicLength = ord(body[0]) * 256 + ord(body[1])
+					self.wfile.write('\x40\x02' + body[2 + topicLength:4 + topicLength])
+			elif kind == 12: # PINGREQ -> PINGRESP
+				self.wfile.write('\xd0\x00')
+			elif kind == 14: # DISCONNECT
+				return
+
+#This class runs the real interceptor handler and records how long it took
+class timedHandler(wh.myHandler):
+
+	def do_GET(self):
+		started = time.time()
+		wh.myHandler.do_GET(self)
+		with handlerLatenciesLock:
+			handlerLatencies.append(time.time() - started)
+
+def countCall(call, calls=1):
+	with upstreamCallsLock:
+		upstreamCalls[call] += calls
+
+def fakeDevice(idx):
+	return {'idx': str(idx), 'Temp': 0.0, 'Humidity': 0, 'Barometer': 0, 'Data': '0;0', 'UVI': '0', \
+			'Radiation': 0, 'Level': 0, 'HaveTimeout': False, 'LastUpdate': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+def startServer(handler):
+	server = wh.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+	thread = threading.Thread(target=server.serve_forever, name=handler.__name__)
+	thread.daemon = True
+	thread.start()
+	return server
+
+def startSocketServer(serverClass, handler):
+	serverClass.allow_reuse_address = True
+	server = serverClass(('127.0.0.1', 0), handler)
+	server.daemon_threads = True
+	thread = threading.Thread(target=server.serve_forever, name=handler.__name__)
+	thread.daemon = True
+	thread.start()
+	return server
+
+def sinksConfig(upstreamPort, tmpFolder):
+	# One of each output sink, against the stand-ins
+	mqtt = startSocketServer(ThreadingTCPServer, fakeMQTTHandler)
+	influxUDP = startSocketServer(UDPServer, fakeInfluxUDPHandler)
+	return [{'type': 'mqtt', 'hostName': '127.0.0.1', 'portNumber': mqtt.server_address[1]}, \
+			{'type': 'influxdb', 'name': 'InfluxDB HTTP', 'url': 'http://127.0.0.1:' + str(upstreamPort) + '/write'}, \
+			{'type': 'influxdb', 'name': 'InfluxDB UDP', 'hostName': '127.0.0.1', 'portNumber': influxUDP.server_address[1]}, \
+			{'type': 'jsonl', 'path': os.path.join(tmpFolder, 'readings-%Y-%m-%d.jsonl')}]
+
+def benchConfig(upstreamPort, tmpFolder):
+	with open(CONFIG_FILE) as f:
+		cfg = json.load(f)
+	cfg['system']['tmpFolder'] = tmpFolder
+	cfg['system']['archivePath'] = os.path.join(tmpFolder, 'archive')
+	cfg['system'].pop('wuSpoolPath', None)
+	cfg['system']['acceptUnknownStations'] = True
+	cfg['system']['maxUnknownStations'] = 1000
+	cfg['system']['windWindows'] = {'60min': 3600}
+	cfg['stations'] = {}
+	cfg['domoticz']['protocol'] = 'http'
+	cfg['domoticz']['hostName'] = '127.0.0.1'
+	cfg['domoticz']['portNumber'] = upstreamPort
+	for i, device in enumerate(cfg['domoticz']['devices']['device']):
+		device['domoticzIdx'] = i + 1
+	return cfg
+
+def sampleReading():
+	# The first line of sample_data.txt is a comment, the others are 'key value' pairs
+	reading = collections.OrderedDict()
+	with open(SAMPLE_FILE) as f:
+		for line in f.readlines()[1:]:
+			if line.strip():
+				key, value = line.strip().split(' ', 1)
+				reading[key] = value
+	return reading
+
+def generateReports(stationId, count):
+	# A random walk around the sample reading, with gusty wind from a wandering direction
+	reading = sampleReading()
+	reading['ID'] = stationId
+	tempf = float(reading['tempf'])
+	windDir = float(reading['winddir'])
+	for i in range(count):
+		tempf += random.gauss(0, 0.05)
+		windDir = (windDir + random.gauss(0, 15)) % 360
+		windSpeed = max(0.0, random.gauss(8, 4))
+		reading['tempf'] = '%.1f' % tempf
+		reading['winddir'] = str(int(windDir))
+		reading['windspeedmph'] = '%.2f' % windSpeed
+		reading['windgustmph'] = '%.2f' % (windSpeed * random.uniform(1.0, 1.8))
+		reading['dateutc'] = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+		yield '/weatherstation/updateweatherstation.php?' + urllib.urlencode(reading)
+
+def replayReports(fileName, stationId):
+	# One URL or query string per line, the station ID is replaced to spread the load
+	with open(fileName) as f:
+		for line in f:
+			line = line.strip()
+			if not line: continue
+			query = dict(urlparse.parse_qsl(urlparse.urlparse(line).query or line))
+			query['ID'] = stationId
+			yield '/weatherstation/updateweatherstation.php?' + urllib.urlencode(query)
+
+def runStation(port, reports, rate, roundTrips, errors):
+	# Send the reports on a fixed schedule, like a station does, whatever the response time
+	interval = 1.0 / rate
+	due = time.time()
+	for path in reports:
+		delay = due - time.time()
+		if delay > 0: time.sleep(delay)
+		due += interval
+		started = time.time()
+		try:
+			urllib2.urlopen('http://127.0.0.1:' + str(port) + path, timeout=30).read()
+			roundTrips.append(time.time() - started)
+		except Exception:
+			errors.append(sys.exc_info()[1])
+
+def percentile(values, p):
+	if not values: return 0.0
+	values = sorted(values)
+	return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def waitForUploads(timeout):
+	# Give the upload workers time to empty their queues
+	deadline = time.time() + timeout
+	workers = [w for sink in wh.sinks for w in sink.workers.values()]
+	while time.time() < deadline and any(w.queue.unfinished_tasks for w in workers):
+		time.sleep(0.1)
+	return sum(w.queue.unfinished_tasks for w in workers), sum(w.dropped for w in workers), sum(w.superseded for w in workers)
+
+def print_help():
+	print 'usage: ' + os.path.basename(__file__) + ' [option]\nOptions and arguments'
+	print '-s N           : number of simulated stations, default 1 (also --stations)'
+	print '-r N           : reports per second per station, default 10 (also --rate)'
+	print '-n N           : reports per station, default 100 (also --reports)'
+	print '--replay FILE  : send the reports in FILE, one URL or query string per line, instead of generated ones'
+	print '--domo-latency S : seconds the Domoticz stand-in takes to answer, default 0'
+	print '--wu-latency S : seconds the WU stand-in takes to answer, default 0'
+	print '--fail-rate F  : fraction of upstream requests answered with 503, default 0'
+	print '--sinks        : also send the readings to stand-ins for MQTT, InfluxDB over HTTP and UDP and to a JSON lines file'
+	print '--influxdb-latency S : seconds the InfluxDB HTTP stand-in takes to answer, default 0'
+	print '-h             : print this help message and exit (also --help)'
+
+def main(argv):
+	global failureRate
+	stationCount = 1
+	rate = 10.0
+	count = 100
+	replayFile = None
+	withSinks = False
+	try:
+		opts, args = getopt.getopt(argv, 'hn:r:s:', ['help', 'reports=', 'rate=', 'stations=', 'replay=', \
+				'domo-latency=', 'wu-latency=', 'fail-rate=', 'sinks', 'influxdb-latency='])
+	except getopt.GetoptError:
+		print_help()
+		sys.exit(2)
+	for opt, arg in opts:
+		if opt in ('-h', '--help'):
+			print_help()
+			sys.exit(0)
+		elif opt in ('-s', '--stations'):
+			stationCount = int(arg)
+		elif opt in ('-r', '--rate'):
+			rate = float(arg)
+		elif opt in ('-n', '--reports'):
+			count = int(arg)
+		elif opt == '--replay':
+			replayFile = arg
+		elif opt == '--domo-latency':
+			upstreamLatency['domoticz'] = float(arg)
+		elif opt == '--wu-latency':
+			upstreamLatency['wu'] = float(arg)
+		elif opt == '--fail-rate':
+			failureRate = float(arg)
+		elif opt == '--sinks':
+			withSinks = True
+		elif opt == '--influxdb-latency':
+			upstreamLatency['influxdb'] = float(arg)
+
+	tmpFolder = tempfile.mkdtemp(prefix='benchWH2600.')
+	upstream = startServer(fakeUpstreamHandler)
+	upstreamPort = upstream.server_address[1]
+	wh.WU_UPDATE_URL = 'http://127.0.0.1:' + str(upstreamPort) + '/weatherstation/updateweatherstation.php'
+	wh.WU_REPLAY_URL = 'http://127.0.0.1:' + str(upstreamPort) + '/replay/updateweatherstation.php'
+	wh.cfg = benchConfig(upstreamPort, tmpFolder)
+	if withSinks: wh.cfg['sinks'] = sinksConfig(upstreamPort, tmpFolder)
+	wh.startUpstreams()
+	wh.startSpool()
+	wh.startSinks()
+	interceptor = startServer(timedHandler)
+
+	gc.collect()
+	memoryBefore = wh.memoryUsage()
+	objectsBefore = len(gc.get_objects())
+	threads, roundTrips, errors = [], [], []
+	started = time.time()
+	for i in range(stationCount):
+		stationId = 'BENCH%03d' % i
+		reports = replayReports(replayFile, stationId) if replayFile else generateReports(stationId, count)
+		thread = threading.Thread(target=runStation, args=(interceptor.server_address[1], reports, rate, roundTrips, errors))
+		thread.start()
+		threads.append(thread)
+	for thread in threads:
+		thread.join()
+	elapsed = time.time() - started
+	pending, dropped, superseded = waitForUploads(30)
+	gc.collect()
+
+	print 'Stations:', stationCount, ' reports:', len(handlerLatencies), ' errors:', len(errors), ' elapsed: %.2f s' % elapsed
+	print 'Throughput: %.1f reports/s' % (len(handlerLatencies) / elapsed)
+	print 'Handler latency ms   p50 %.2f  p90 %.2f  p99 %.2f  max %.2f' % tuple(percentile(handlerLatencies, p) * 1000 for p in (50, 90, 99, 100))
+	print 'Round trip latency ms p50 %.2f  p90 %.2f  p99 %.2f  max %.2f' % tuple(percentile(roundTrips, p) * 1000 for p in (50, 90, 99, 100))
+	print 'Upstream calls:'
+	for call, calls in sorted(upstreamCalls.items()):
+		print '  %-32s %d' % (call, calls)
+	print 'Readings still queued:', pending, ' dropped by full queues:', dropped, ' superseded by newer ones:', superseded
+	for station in sorted(wh.stations):
+		rtfreq = wh.sinks[0].rtfreq.get(station)
+		if rtfreq: print '  %s effective WU rtfreq %.1f s' % (station, rtfreq[1])
+	print 'Memory growth: %d kB RSS, %d Python objects' % (wh.memoryUsage() - memoryBefore, len(gc.get_objects()) - objectsBefore)
+	shutil.rmtree(tmpFolder, ignore_errors=True)
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
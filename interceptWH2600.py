@@ -24,11 +24,20 @@
 '''
 
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from multiprocessing.pool import ThreadPool
 #from os import curdir, sep
-import json, urlparse, requests
-import os, getopt, sys, socket
+import json, urlparse, urllib, requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+import os, getopt, sys, socket, signal, re
+import threading, Queue, time, collections, functools, operator, calendar, bisect, struct
 from datetime import datetime
-import math, cmath, scipy
+import _strptime # Imported before any thread calls strptime, the lazy import isn't thread safe in Python 2
+import math, cmath
+import cProfile, pstats, gc, resource
+from cStringIO import StringIO
+# NumPy takes seconds to import on a Raspberry Pi, it's imported where the archive queries and batch statistics need it
 
 PROGRAM_NAME = 'WH2600 Interceptor'
 VERSION = '1.0.3'
@@ -36,233 +45,1585 @@ MSG_ERROR = 'Error'
 MSG_INFO = 'Info'
 MSG_EXEC = 'Exec info'
 WU_UPDATE_URL = 'https://rtupdate.wunderground.com/weatherstation/updateweatherstation.php'
+WU_REPLAY_URL = 'https://weatherstation.wunderground.com/weatherstation/updateweatherstation.php'
 WU_SOFTWARE_TYPE = PROGRAM_NAME + ' V. ' + VERSION
 UPDATE_INTERV = 10 # Expected Weather Station report Interval in seconds
-UPDATE_DOMO_INTERV = 6 # Weather Station report Interval that Domoticz will by updated by
+MAX_UNKNOWN_STATIONS = 1 # Default number of stations not listed in config.json that are served
+STATION_ID = re.compile(r'[A-Za-z0-9_-]{1,64}\Z') # Station IDs accepted, they end up in metric labels and file names
+WU_MIN_INTERV = 5 # Default minimum seconds between two rapid fire uploads of a station
+RTFREQ_SMOOTHING = 0.2 # Weight of the latest interval in the effective rapid fire frequency reported to WU
+DOMO_MAX_INTERV = 3000 # Default seconds after which a Domoticz device is updated anyway, so that it doesn't time out
+DOMO_WRITE_WORKERS = 4 # Default number of Domoticz device updates sent at the same time
+UPLOAD_QUEUE_DEPTH = 60 # Default number of readings an upload worker may hold back (10 minutes of reports)
+OVERFLOW_POLICIES = ('dropOldest', 'dropNewest', 'keepLatest')
+DOMO_CACHE_TTL = 3600 # Seconds before the shadow cache of Domoticz devices is fetched again
+HTTP_CONNECT_TIMEOUT = 3.05 # Default seconds to wait for an upstream server to accept the connection
+HTTP_READ_TIMEOUT = 10 # Default seconds to wait for an upstream server to answer
+HTTP_RETRIES = 3 # Default number of retries of a failed upstream request
+HTTP_BACKOFF = 0.5 # Default backoff factor, retries wait 0.5, 1, 2... seconds
+HTTP_MAX_HOLDOFF = 300 # Never hold off from a failing upstream server for more than 5 minutes
+HTTP_POOL_SIZE = 10 # Default number of keep-alive connections kept per upstream server
+SPOOL_FILE = 'interceptWH2600.spool' # Default name of the WU spool file in system.tmpFolder
+SPOOL_MAX_BYTES = 10 * 1024 * 1024 # Default maximum size of the WU spool file, about 10 days of one station
+SPOOL_REPLAY_RATE = 1.0 # Default number of spooled readings replayed to WU per second
+SPOOL_FLUSH_INTERV = 5 # Seconds between flushes of the spool file while nothing is being replayed
+METRICS_PATH = '/metrics' # Default path of the Prometheus metrics page on the listening port
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+ARCHIVE_FLUSH_INTERV = 60 # Default seconds between flushes of the archive files
+SINK_BATCH_SIZE = 50 # Default number of readings a batching sink writes at once
+MQTT_TOPIC = 'wh2600/{station}' # Default MQTT topic, {station} is replaced by the station ID
+MQTT_KEEPALIVE = 60 # Seconds between MQTT keep alive messages
+INFLUXDB_MEASUREMENT = 'wh2600' # Default InfluxDB measurement name
+UDP_MAX_DATAGRAM = 1400 # Lines sent to InfluxDB over UDP are grouped in datagrams up to this size, one Ethernet frame
+MQTT_ROLLUP_TOPIC = 'wh2600/{station}/{resolution}' # Default MQTT topic of the rollups
+# Default lengths in seconds of the tumbling windows that readings are rolled up into, windows start at whole UTC multiples
+ROLLUP_RESOLUTIONS = {'1min': 60, '5min': 300, 'hourly': 3600, 'daily': 86400}
+ROLLUP_MAX_GAP = 2 * UPDATE_INTERV # Seconds without readings over a restart after which the open rollups are marked partial
+BARO_TENDENCY_WINDOW = 3 * 3600 # Seconds of pressure history the barometric tendency is taken over
+BARO_MIN_HISTORY = 3600 # Seconds of pressure history needed before there is a forecast
+BARO_SAMPLE_INTERV = 60 # Seconds between the pressures kept for the tendency
+RAIN_RATE_WINDOW = 600 # Seconds of rain the rain rate is averaged over
+RAIN_MAX_FALL = 500 # Hundredths of inches of rain between two readings beyond which the daily accumulator is taken to be wrong
+CHECKPOINT_FILE = 'interceptWH2600.state' # Default name of the checkpoint file in system.tmpFolder
+CHECKPOINT_INTERV = 30 # Default seconds between checkpoints of the rolling wind windows, rollups and counters
+CHECKPOINT_MAX_AGE = 600 # Default seconds after its latest reading that the checkpointed state of a station is still restored
+CHECKPOINT_MAGIC = 'WH2600C4' # Start of a checkpoint file, changes with the file format
+DEBUG_PATH = '/debug' # Default path prefix of the runtime diagnostics on the listening port
+PROFILE_SECONDS = 60 # Default seconds a profile capture runs
+PROFILE_TOP = 40 # Number of functions in the text summary of a profile
+MEMORY_TOP = 25 # Number of object types in a memory report
+VERBOSITY_LEVELS = ('quiet', 'verbose', 'debug')
+HEALTH_CHECK_INTERV = 300 # Default seconds between checks of the internet and Domoticz connections
+HEALTH_PATH = '/health' # Default path of the JSON health status on the listening port
+
+# Parameters of a WH2600 report and the ones added by the interceptor: name, type, units and
+# the destinations the value is passed on to. Anything else the station sends is kept as text and passed on to WU.
+# 'outputs' are the sinks of the sinks section of config.json, they get every measurement
+TO_WU = ('wu',)
+TO_DOMO = ('domoticz', 'outputs')
+TO_WU_DOMO = ('wu', 'domoticz', 'outputs')
+TO_DOMO_ARCHIVE = ('domoticz', 'archive', 'outputs')
+TO_ALL = ('wu', 'domoticz', 'archive', 'outputs')
+FIELD_SCHEMA = (
+	('ID', str, None, TO_WU),
+	('PASSWORD', str, None, TO_WU),
+	('action', str, None, TO_WU),
+	('realtime', int, None, TO_WU),
+	('rtfreq', int, 's', TO_WU),
+	('dateutc', str, None, TO_WU),
+	('softwaretype', str, None, TO_WU),
+	('tempf', float, 'F', TO_ALL),
+	('humidity', int, '%', TO_ALL),
+	('dewptf', float, 'F', ('wu', 'archive', 'outputs')),
+	('windchillf', float, 'F', TO_DOMO_ARCHIVE),
+	('baromin', float, 'inHg', TO_ALL),
+	('windspeedmph', float, 'mph', TO_ALL),
+	('windgustmph', float, 'mph', TO_ALL),
+	('winddir', int, 'deg', TO_ALL),
+	('rainin', float, 'in', TO_ALL),
+	('dailyrainin', float, 'in', TO_ALL),
+	('weeklyrainin', float, 'in', TO_DOMO_ARCHIVE),
+	('monthlyrainin', float, 'in', TO_DOMO_ARCHIVE),
+	('yearlyrainin', float, 'in', TO_DOMO_ARCHIVE),
+	('solarradiation', float, 'W/m2', TO_ALL),
+	('UV', int, 'index', TO_ALL),
+	('indoortempf', float, 'F', TO_ALL),
+	('indoorhumidity', int, '%', TO_ALL),
+	('lowbatt', int, None, TO_DOMO_ARCHIVE),
+	('windspdmph_avg2m', float, 'mph', TO_WU_DOMO),
+	('windspdmph_avg10m', float, 'mph', TO_WU_DOMO),
+	('windgustmph_2m', float, 'mph', TO_WU_DOMO),
+	('windgustmph_10m', float, 'mph', TO_WU_DOMO),
+	('winddir_avg2m', int, 'deg', TO_WU_DOMO),
+	('winddir_avg10m', int, 'deg', TO_DOMO),
+	# Derived from the reading by Meteo, once for every destination
+	('tempc', float, 'C', TO_DOMO),
+	('indoortempc', float, 'C', TO_DOMO),
+	('dewptc', float, 'C', TO_DOMO),
+	('heatindexf', float, 'F', TO_DOMO),
+	('heatindexc', float, 'C', TO_DOMO),
+	('windchillc', float, 'C', TO_DOMO),
+	('baromhpa', float, 'hPa', TO_DOMO),
+	('barotrendhpa', float, 'hPa/3h', TO_DOMO),
+	('baroforecast', int, None, TO_DOMO),
+	('windspeedms', float, 'm/s', TO_DOMO),
+	('windgustms', float, 'm/s', TO_DOMO),
+	('windspdms_avg2m', float, 'm/s', TO_DOMO),
+	('windspdms_avg10m', float, 'm/s', TO_DOMO),
+	('windgustms_2m', float, 'm/s', TO_DOMO),
+	('windgustms_10m', float, 'm/s', TO_DOMO),
+	('rainmm', float, 'mm', TO_DOMO),
+	('dailyrainmm', float, 'mm', TO_DOMO),
+	('yearlyrainmm', float, 'mm', TO_DOMO),
+	('rainratemm', float, 'mm/h', TO_DOMO),
+	('rainfallin', float, 'in', ('outputs',)), # Rain since the previous reading
+)
+FIELDS = dict((f[0], f) for f in FIELD_SCHEMA)
+# The statistics of the wind windows added in config.json are named at runtime, e.g. windspdmph_avg60min.
+# They go where the ones of the 2 minutes window go
+WINDOW_FIELDS = (('windspdmph_avg', FIELDS['windspdmph_avg2m']), ('windgustmph_', FIELDS['windgustmph_2m']), \
+		('winddir_avg', FIELDS['winddir_avg2m']))
+# Columns of the archive. Each is stored as little-endian float32, missing values as NaN,
+# next to a 'time' column of uint32 UTC epoch seconds
+ARCHIVE_FIELDS = tuple(f[0] for f in FIELD_SCHEMA if 'archive' in f[3])
+NAN = float('nan')
+FLOAT32_MAX = 3.4028234663852886e38 # Largest value an archive column can hold
 
 # Global (module) namespace variables
 cfgFile = sys.path[0] + '/config.json'
 tty = True if os.isatty(sys.stdin.fileno()) else False
 isDebug = False
 isVerbose = False
-runs = 0
+wuUpstream = None
+internetUpstream = None
+defaultDomoticz = None
+wuSpool = None
+sinks = []
+healthChecker = None
+checkpoint = None
+
+# Domoticz servers keyed by URL and weather stations keyed by their ID
+domoticzServers = {}
+stations = {}
+stationsLock = threading.RLock()
+
+
+#This class collects counters, gauges and latency histograms and renders them in the Prometheus text format.
+#Labels are tuples of (name, value) pairs
+class Metrics(object):
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.counters = {}
+		self.histograms = {} # (name, labels) -> [count per bucket..., count above the last bucket, sum]
+		self.gauges = {} # (name, labels) -> function returning the current value
+		self.help = {}
+
+	def describe(self, name, kind, text):
+		self.help[name] = (kind, text)
+
+	def inc(self, name, labels=(), value=1):
+		key = (name, labels)
+		with self.lock:
+			self.counters[key] = self.counters.get(key, 0) + value
+
+	def observe(self, name, seconds, labels=()):
+		key = (name, labels)
+		i = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+		with self.lock:
+			h = self.histograms.get(key)
+			if h is None:
+				h = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+			h[i] += 1
+			h[-1] += seconds
+
+	def gauge(self, name, func, labels=()):
+		self.gauges[(name, labels)] = func
 
-# Global variables for Wind data
-average_wind_speed_2min = 0
-average_wind_speed_10min = 0
-max_gust_speed_2min = 0
-max_gust_speed_10min = 0
-wdir_2min = 0
-wdir_10min = 0
-arrWindDir = {}
-arrWindSpeed = {}
-arrGustSpeed = {}
+	def render(self):
+		lines = []
+		with self.lock:
+			counters = sorted(self.counters.items())
+			histograms = sorted((key, list(h)) for key, h in self.histograms.items())
+		gauges = sorted(self.gauges.items())
+		described = set()
+		for (name, labels), value in counters:
+			self.header(lines, described, name, 'counter')
+			lines.append(name + formatLabels(labels) + ' ' + repr(value))
+		for (name, labels), func in gauges:
+			self.header(lines, described, name, 'gauge')
+			try:
+				lines.append(name + formatLabels(labels) + ' ' + repr(func()))
+			except Exception:
+				pass
+		for (name, labels), h in histograms:
+			self.header(lines, described, name, 'histogram')
+			cumulative = 0
+			for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), h[:-1]):
+				cumulative += count
+				lines.append(name + '_bucket' + formatLabels(labels + (('le', str(bound)),)) + ' ' + str(cumulative))
+			lines.append(name + '_sum' + formatLabels(labels) + ' ' + repr(h[-1]))
+			lines.append(name + '_count' + formatLabels(labels) + ' ' + str(cumulative))
+		return '\n'.join(lines) + '\n'
 
+	def header(self, lines, described, name, kind):
+		if name in described: return
+		described.add(name)
+		kind, text = self.help.get(name, (kind, ''))
+		if text: lines.append('# HELP ' + name + ' ' + text)
+		lines.append('# TYPE ' + name + ' ' + kind)
+
+def formatLabels(labels):
+	if not labels: return ''
+	return '{' + ','.join(k + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"') + '"' for k, v in labels) + '}'
+
+metrics = Metrics()
+metrics.describe('wh2600_readings_total', 'counter', 'Readings received per station')
+metrics.describe('wh2600_stage_seconds', 'histogram', 'Time spent in each stage of the report handler')
+metrics.describe('wh2600_upstream_request_seconds', 'histogram', 'Duration of upstream requests, retries included')
+metrics.describe('wh2600_upstream_requests_total', 'counter', 'Upstream requests by result')
+metrics.describe('wh2600_upstream_retries_total', 'counter', 'Upstream request attempts that were retried')
+metrics.describe('wh2600_delivery_seconds', 'histogram', 'Time an upload worker spent delivering one reading')
+metrics.describe('wh2600_domoticz_device_seconds', 'histogram', 'Time spent checking whether one Domoticz device is due an update')
+metrics.describe('wh2600_domoticz_writes_total', 'counter', 'Domoticz device updates by reason')
+metrics.describe('wh2600_queue_depth', 'gauge', 'Readings waiting in an upload queue')
+metrics.describe('wh2600_dropped_readings_total', 'counter', 'Readings dropped because an upload queue was full')
+metrics.describe('wh2600_superseded_readings_total', 'counter', 'Readings replaced by a newer one before they were sent')
+metrics.describe('wh2600_wu_rtfreq_seconds', 'gauge', 'Effective seconds between rapid fire uploads to WU, as reported in rtfreq')
+metrics.describe('wh2600_spool_bytes', 'gauge', 'Size of the WU spool file')
+metrics.describe('wh2600_spooled_readings_total', 'counter', 'WU readings written to the spool')
+metrics.describe('wh2600_replayed_readings_total', 'counter', 'Spooled WU readings delivered')
+metrics.describe('wh2600_rollups_total', 'counter', 'Rollup buckets closed and passed on to the sinks')
+metrics.describe('wh2600_up', 'gauge', 'Whether the latest health check of a connection succeeded')
+
+STAGE_PARSE = (('stage', 'parse'),)
+STAGE_REPLY = (('stage', 'reply'),)
+STAGE_WIND = (('stage', 'wind'),)
+STAGE_DERIVE = (('stage', 'derive'),)
+STAGE_QUEUE = (('stage', 'queue'),)
+STAGE_TOTAL = (('stage', 'total'),)
 
 #This class will handles any incoming request from PWS
 class myHandler(BaseHTTPRequestHandler):
 	
 	#Handler for the GET requests
 	def do_GET(self):
+		# Runs under the profiler while a capture is on
+		profiler.run(self.handleGET)
+
+	def handleGET(self):
 		#print self.path
-		global runs
-		runs+=1
-
-		jsonQs = dict(urlparse.parse_qsl(urlparse.urlparse(self.path).query))
-		if isDebug: print 'Received data for station ID : ', jsonQs['ID']
-		# Make numbers within quotes numerical
-		for key in jsonQs:
-			value = jsonQs[key]
-			if value.replace('-','').isdigit():
-				jsonQs[key] = int(value)
-			elif is_number(value):
-				jsonQs[key] = float(value)
+		started = time.time()
+		url = urlparse.urlparse(self.path)
+		if url.path == cfg['system'].get('metricsPath', METRICS_PATH):
+			self.sendMetrics()
+			return
+		if url.path == cfg['system'].get('healthPath', HEALTH_PATH):
+			self.sendHealth()
+			return
+		if url.path.startswith(cfg['system'].get('debugPath', DEBUG_PATH) + '/'):
+			self.sendDebug(url)
+			return
+		jsonQs = decodeReport(url.query)
+		if isDebug: print 'Received data for station ID : ', jsonQs.get('ID')
+		if not STATION_ID.match(jsonQs.get('ID', '')):
+			# Not a station report, a browser asking for / or /favicon.ico for instance
+			if isVerbose: print 'Ignoring request without a valid station ID : ', self.path
+			self.send_response(400)
+			self.end_headers()
+			return
+		station = getStation(jsonQs['ID'])
+		if station is None:
+			if isVerbose: print 'Ignoring data from unknown station ID : ', jsonQs.get('ID')
+			self.send_response(403)
+			self.end_headers()
+			return
+		metrics.inc('wh2600_readings_total', station.labels)
 
 		# Cleansing and Data Processing
 		jsonQs['softwaretype'] = WU_SOFTWARE_TYPE
 		jsonQs['dateutc'] = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-		jsonQs['rtfreq'] = 12
 
 		if isVerbose and isDebug:
 			for key, value in jsonQs.items():
 				print key, value
 		#print jsonQs
+		parsed = time.time()
+		metrics.observe('wh2600_stage_seconds', parsed - started, STAGE_PARSE)
 		# Send a reply to the WH2600
 		mimetype='text/html'
 		self.send_response(200)
 		self.send_header('Content-type',mimetype)
 		self.end_headers()
 		self.wfile.write('success\n')
+		replied = time.time()
+		metrics.observe('wh2600_stage_seconds', replied - parsed, STAGE_REPLY)
 
-		saveWindData(jsonQs)
-		if ((runs % UPDATE_DOMO_INTERV == 0) or (runs == 1)):
-			if isVerbose: print 'Checking if Domoticz devices needs to be updated...'
-			updateDomoticz(jsonQs)
+		# Readings of one station are processed in order, other stations go on in parallel.
+		# Every sink queues the reading for its own workers, none of them can hold up the others
+		with station.lock:
+			station.runs += 1
+			station.lastReading = time.time()
+			for sink in sinks:
+				if sink.beforeWind: sink.put(station, jsonQs)
+			# Rollups take the wind direction as measured too
+			measured = payloadFor(jsonQs, 'archive') if station.rollups else None
+			windStarted = time.time()
+			saveWindData(station, jsonQs)
+			deriveStarted = time.time()
+			metrics.observe('wh2600_stage_seconds', deriveStarted - windStarted, STAGE_WIND)
+			station.meteo.derive(deriveStarted, jsonQs)
+			metrics.observe('wh2600_stage_seconds', time.time() - deriveStarted, STAGE_DERIVE)
+			for sink in sinks:
+				if not sink.beforeWind: sink.put(station, jsonQs)
+			closed = station.rollups.push(time.time(), measured, jsonQs.get('rainfallin', 0.0)) if station.rollups else ()
+			for resolution, bucket in closed:
+				summary = bucket.summary(resolution)
+				metrics.inc('wh2600_rollups_total', (('resolution', resolution),))
+				for sink in sinks:
+					sink.putRollup(station, bucket.start, summary)
 			if isDebug: print jsonQs
 
-		# Get rid of some elements that we don't need to send to WU
-		del jsonQs['lowbatt']
-		del jsonQs['windchillf']
-		del jsonQs['monthlyrainin']
-		del jsonQs['yearlyrainin']
-		del jsonQs['weeklyrainin']
-		del jsonQs['winddir_avg10m']
-		updateWU(jsonQs)
+		finished = time.time()
+		metrics.observe('wh2600_stage_seconds', finished - replied, STAGE_QUEUE)
+		metrics.observe('wh2600_stage_seconds', finished - started, STAGE_TOTAL)
 		return
 
+	def sendMetrics(self):
+		body = metrics.render()
+		self.send_response(200)
+		self.send_header('Content-type', 'text/plain; version=0.0.4')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def sendDebug(self, url):
+		# Diagnostics of the running process, from the local host only unless system.debugAllowRemote is true
+		if self.client_address[0] not in ('127.0.0.1', '::1') and not cfg['system'].get('debugAllowRemote', False):
+			self.sendText(403, 'Diagnostics are only available from the local host\n')
+			return
+		command = url.path[len(cfg['system'].get('debugPath', DEBUG_PATH)) + 1:]
+		args = dict(urlparse.parse_qsl(url.query))
+		if command == 'profile':
+			try:
+				seconds = float(args.get('seconds', cfg['system'].get('profileSeconds', PROFILE_SECONDS)))
+			except ValueError:
+				seconds = None
+			if seconds is None or not 0 < seconds < float('inf'):
+				self.sendText(400, 'The number of seconds to profile must be a positive number\n')
+				return
+			if profiler.start(seconds):
+				self.sendText(200, 'Profiling the report handler for ' + str(seconds) + ' s, the statistics go to ' + \
+						cfg['system']['tmpFolder'] + '\n')
+			else:
+				self.sendText(409, 'A profile capture is running already\n')
+		elif command == 'memory':
+			self.sendText(200, memoryTracker.report())
+		elif command == 'verbosity':
+			if 'level' in args and args['level'] not in VERBOSITY_LEVELS:
+				self.sendText(400, 'Unknown level, use one of ' + ', '.join(VERBOSITY_LEVELS) + '\n')
+				return
+			if 'level' in args: setVerbosity(args['level'])
+			self.sendText(200, 'Verbosity is ' + getVerbosity() + '\n')
+		else:
+			self.sendText(404, 'Unknown command, use profile?seconds=N, memory or verbosity?level=' + \
+					'|'.join(VERBOSITY_LEVELS) + '\n')
+
+	def sendText(self, status, body):
+		self.send_response(status)
+		self.send_header('Content-type', 'text/plain')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def sendHealth(self):
+		body = json.dumps(healthChecker.status() if healthChecker is not None else {'status': 'starting'}) + '\n'
+		self.send_response(200)
+		self.send_header('Content-type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
 	def log_message(self, format, *args):
 		return # Quiet please
 
-def updateWU(payload):
+def decodeReport(query):
+	# One pass over the query string, converting every known parameter to its type from the schema.
+	# Values that don't convert are left out, unknown parameters are kept as text
+	reading = {}
+	for pair in query.split('&'):
+		key, _, value = pair.partition('=')
+		if not value: continue
+		# Only text like dateutc or softwaretype needs unquoting, numbers come as they are
+		if '%' in value or '+' in value: value = urllib.unquote_plus(value)
+		field = FIELDS.get(key)
+		if field is None:
+			reading[key] = value
+			continue
+		try:
+			converted = field[1](value)
+		except ValueError:
+			try:
+				# Some firmware versions report whole numbers with decimals
+				converted = int(float(value)) if field[1] is int else None
+			except (ValueError, OverflowError):
+				converted = None
+		# nan and inf are no measurement, they would end up in the rollups and the sinks
+		if converted is None or (field[1] is float and (math.isnan(converted) or math.isinf(converted))):
+			if isVerbose: print 'Ignoring invalid value for', key, ':', value
+			continue
+		reading[key] = converted
+	return reading
+
+def payloadFor(reading, destination):
+	# The part of a reading that a destination wants, according to the schema
+	payload = {}
+	for key, value in reading.iteritems():
+		field = FIELDS.get(key)
+		if field is None:
+			for prefix, like in WINDOW_FIELDS:
+				if key.startswith(prefix) and not isinstance(value, str):
+					field = like
+					break
+		if field is None:
+			if destination == 'wu' and isinstance(value, str): payload[key] = value
+		elif destination in field[3]:
+			payload[key] = value
+	return payload
+
+#This class lets every incoming request run on its own thread
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+#This class holds everything that belongs to one weather station
+class Station(object):
+
+	def __init__(self, stationId, stationCfg, unknown=False, domoDevices=True):
+		self.id = stationId
+		self.unknown = unknown # Not listed in the stations section of config.json
+		self.labels = (('station', stationId),)
+		self.wu = stationCfg.get('wu', {})
+		self.wuMinInterval = stationCfg.get('wuMinInterval', cfg['system'].get('wuMinInterval', WU_MIN_INTERV))
+		domoCfg = stationCfg.get('domoticz', cfg['domoticz'])
+		self.domoticz = getDomoticz(domoCfg)
+		# The server connection is shared, the device list and its update schedule belong to the station
+		self.domoUpdaters = compileDomoDevices(self.domoticz, domoCfg) if domoDevices else []
+		self.lock = threading.Lock()
+		self.runs = 0
+		self.lastReading = None
+		self.wuFailing = False # Whether the latest upload to WU failed, only changes are logged to Domoticz
+		self.windStats = WindStats(windWindows())
+		self.meteo = Meteo()
+		resolutions = rollupResolutions()
+		self.rollups = Rollups(resolutions) if resolutions else None
+		# After a restart the windows carry on from the checkpoint instead of starting from the first reading
+		if checkpoint is not None: checkpoint.restore(self)
+
+def getStation(stationId):
+	# Stations listed in config.json have their own WU credentials and Domoticz server, any other
+	# station uses the top level settings unless system.acceptUnknownStations is false. Only up to
+	# system.maxUnknownStations of those are served, and only the first one updates the top level Domoticz
+	# devices, more would overwrite each other's values. IDs that aren't letters, digits, _ or - never become a station
+	if not STATION_ID.match(stationId): return None
+	with stationsLock:
+		station = stations.get(stationId)
+		if station is None:
+			stationCfg = cfg.get('stations', {}).get(stationId)
+			if stationCfg is not None:
+				station = Station(stationId, stationCfg)
+			else:
+				if not cfg['system'].get('acceptUnknownStations', True): return None
+				unknown = sum(1 for s in stations.itervalues() if s.unknown)
+				if unknown >= cfg['system'].get('maxUnknownStations', MAX_UNKNOWN_STATIONS): return None
+				station = Station(stationId, {}, unknown=True, domoDevices=unknown == 0)
+			stations[stationId] = station
+			if isVerbose: print 'Serving weather station', stationId
+	return station
+
+class UpstreamError(Exception):
+	pass
+
+#This class is a urllib3 retry policy that counts the retries it allows
+class CountedRetry(Retry):
+	labels = ()
+
+	def new(self, **kw):
+		retry = Retry.new(self, **kw)
+		retry.labels = self.labels
+		return retry
+
+	def increment(self, *args, **kwargs):
+		retry = Retry.increment(self, *args, **kwargs) # Raises when the retries are used up
+		metrics.inc('wh2600_upstream_retries_total', self.labels)
+		return retry
+
+#This class holds the keep-alive connection pool, timeouts and retry policy for one upstream server
+class Upstream(object):
+
+	def __init__(self, name, url, auth=None, verify=True):
+		self.name = name
+		self.url = url
+		self.timeout = (cfg['system'].get('httpConnectTimeout', HTTP_CONNECT_TIMEOUT), \
+				cfg['system'].get('httpReadTimeout', HTTP_READ_TIMEOUT))
+		self.backoff = cfg['system'].get('httpBackoff', HTTP_BACKOFF)
+		self.labels = (('upstream', name),)
+		retry = CountedRetry(total=cfg['system'].get('httpRetries', HTTP_RETRIES), backoff_factor=self.backoff, \
+				status_forcelist=(500, 502, 503, 504))
+		retry.labels = self.labels
+		self.session = requests.Session()
+		self.session.auth = auth
+		self.session.verify = verify
+		poolSize = cfg['system'].get('httpPoolSize', HTTP_POOL_SIZE)
+		self.session.mount('http://', HTTPAdapter(max_retries=retry, pool_maxsize=poolSize))
+		self.session.mount('https://', HTTPAdapter(max_retries=retry, pool_maxsize=poolSize))
+		self.failures = 0
+		self.holdOffUntil = 0
+
+	def request(self, method, params=None, url=None, data=None):
+		# A server that keeps failing is left alone for an exponentially growing while
+		# so that the workers degrade to fast failures instead of piling up timeouts
+		started = time.time()
+		if started < self.holdOffUntil:
+			metrics.inc('wh2600_upstream_requests_total', self.labels + (('result', 'held off'),))
+			raise UpstreamError(self.name + ' is unavailable, holding off for ' + str(int(self.holdOffUntil - started)) + ' s')
+		try:
+			r = self.session.request(method, url or self.url, params=params, data=data, timeout=self.timeout)
+		except requests.RequestException as e:
+			self.failures += 1
+			self.holdOffUntil = time.time() + min(HTTP_MAX_HOLDOFF, self.backoff * 2 ** self.failures)
+			metrics.observe('wh2600_upstream_request_seconds', time.time() - started, self.labels)
+			metrics.inc('wh2600_upstream_requests_total', self.labels + (('result', 'error'),))
+			raise UpstreamError(self.name + ' request failed: ' + str(e))
+		metrics.observe('wh2600_upstream_request_seconds', time.time() - started, self.labels)
+		metrics.inc('wh2600_upstream_requests_total', self.labels + (('result', str(r.status_code)),))
+		self.failures = 0
+		self.holdOffUntil = 0
+		return r
+
+	def get(self, params=None, url=None):
+		return self.request('GET', params, url)
+
+def startUpstreams():
+	global defaultDomoticz, wuUpstream, internetUpstream
+	defaultDomoticz = getDomoticz(cfg['domoticz'])
+	wuUpstream = Upstream('WU', WU_UPDATE_URL)
+	internetUpstream = Upstream('Internet', 'http://www.google.com/')
+
+#This class drains a bounded queue of readings to one destination on a background thread.
+#The target gets a list of the readings waiting, up to batchSize of them, at most once every minInterval seconds
+class UploadWorker(threading.Thread):
+
+	def __init__(self, name, target, depth=UPLOAD_QUEUE_DEPTH, policy='dropOldest', batchSize=1, minInterval=0):
+		threading.Thread.__init__(self, name=name)
+		self.daemon = True
+		self.target = target
+		self.batchSize = max(1, batchSize)
+		self.minInterval = minInterval
+		self.lastRun = 0
+		self.policy = policy if policy in OVERFLOW_POLICIES else 'dropOldest'
+		self.queue = Queue.Queue(depth)
+		self.dropped = 0
+		self.superseded = 0
+		self.putLock = threading.Lock()
+		self.labels = (('worker', name),)
+		metrics.gauge('wh2600_queue_depth', self.queue.qsize, self.labels)
+
+	def put(self, reading):
+		# Never blocks the caller. When the queue is full the overflow policy decides what is lost:
+		# dropOldest evicts the oldest queued reading, dropNewest discards the new one
+		# and keepLatest supersedes everything queued so that only the new reading is left.
+		with self.putLock:
+			while True:
+				try:
+					self.queue.put_nowait(reading)
+					return True
+				except Queue.Full:
+					if self.policy == 'dropNewest':
+						self.dropped += 1
+						metrics.inc('wh2600_dropped_readings_total', self.labels)
+						if isVerbose: print self.name, 'queue is full, dropping the newest reading'
+						return False
+				try:
+					while True:
+						self.queue.get_nowait()
+						self.queue.task_done()
+						if self.policy == 'keepLatest':
+							self.superseded += 1
+							metrics.inc('wh2600_superseded_readings_total', self.labels)
+						else:
+							self.dropped += 1
+							metrics.inc('wh2600_dropped_readings_total', self.labels)
+						if self.policy == 'dropOldest': break
+				except Queue.Empty:
+					pass
+				if isVerbose and self.policy != 'keepLatest':
+					print self.name, 'queue is full, dropped older readings (' + str(self.dropped) + ' so far)'
+
+	def run(self):
+		while True:
+			batch = [self.queue.get()]
+			delay = self.lastRun + self.minInterval - time.time()
+			if delay > 0:
+				time.sleep(delay)
+				# When only the latest reading counts, one that came in while waiting supersedes the one taken
+				if self.policy == 'keepLatest': batch = self.latest(batch)
+			try:
+				while len(batch) < self.batchSize:
+					batch.append(self.queue.get_nowait())
+			except Queue.Empty:
+				pass
+			started = time.time()
+			self.lastRun = started
+			try:
+				self.target(batch)
+			except Exception:
+				# An upstream failure must not kill the worker, the next readings get a new chance
+				print self.name, 'failed to deliver', len(batch), 'reading(s):', sys.exc_info()[1]
+			finally:
+				for reading in batch:
+					self.queue.task_done()
+				metrics.observe('wh2600_delivery_seconds', time.time() - started, self.labels)
+
+	def latest(self, batch):
+		try:
+			while True:
+				reading = self.queue.get_nowait()
+				for superseded in batch:
+					self.queue.task_done()
+					self.superseded += 1
+					metrics.inc('wh2600_superseded_readings_total', self.labels)
+				batch = [reading]
+		except Queue.Empty:
+			return batch
+
+# Sink classes by the type used in the sinks section of config.json
+SINK_TYPES = {}
+
+def sinkType(name):
+	# Class decorator that adds a sink to the registry
+	def register(cls):
+		SINK_TYPES[name] = cls
+		return cls
+	return register
+
+#This class is an output that every reading is passed on to. A sink has its own upload workers, one per station
+#or one for all, each with its own queue, overflow policy and batch size
+class Sink(object):
+	destination = 'outputs' # Schema destination of the fields the sink gets, see payloadFor
+	perStation = False # One worker per station, so that stations don't wait for each other
+	beforeWind = False # Gets the reading as the station sent it, before the wind statistics are added
+	batchSize = 1
+
+	def __init__(self, name, sinkCfg):
+		self.name = name
+		self.cfg = sinkCfg
+		self.depth = sinkCfg.get('queueDepth', cfg['system'].get('uploadQueueDepth', UPLOAD_QUEUE_DEPTH))
+		self.policy = sinkCfg.get('overflowPolicy', cfg['system'].get('uploadOverflowPolicy', 'dropOldest'))
+		self.batchSize = sinkCfg.get('batchSize', self.batchSize)
+		self.readings = sinkCfg.get('readings', True) # False for a sink that only wants rollups
+		self.rollups = set(sinkCfg.get('rollups', ())) # Names of the rollup resolutions the sink wants
+		self.workers = {} # station ID, or None when perStation is false -> UploadWorker
+		self.lock = threading.Lock()
+
+	def put(self, station, reading):
+		# Never blocks, the reading is queued with the time it was received
+		if not self.readings: return
+		payload = self.payload(station, reading)
+		if payload: self.worker(station).put((station, time.time(), payload))
+
+	def putRollup(self, station, start, summary):
+		# A closed rollup bucket goes through the same workers, its payload tells the resolution
+		if summary['resolution'] in self.rollups: self.worker(station).put((station, start, summary))
+
+	def payload(self, station, reading):
+		return payloadFor(reading, self.destination)
+
+	def worker(self, station):
+		key = station.id if self.perStation else None
+		worker = self.workers.get(key)
+		if worker is None:
+			with self.lock:
+				worker = self.workers.get(key)
+				if worker is None:
+					name = (station.id + ' ' if self.perStation else '') + self.name + ' uploader'
+					worker = self.workers[key] = UploadWorker(name, self.write, self.depth, self.policy, self.batchSize, \
+							self.minInterval(station))
+					worker.start()
+		return worker
+
+	def minInterval(self, station):
+		# Seconds a worker waits between two deliveries, 0 to deliver as fast as the destination takes them
+		return 0
+
+	def write(self, batch):
+		# Delivers a list of (station, epoch received, payload), an exception counts as a failure for all of them
+		raise NotImplementedError
+
+def sinkRecord(station, timestamp, payload):
+	# A reading as a JSON object, for the sinks that don't have a format of their own
+	record = dict(payload)
+	record['station'] = station.id
+	record['time'] = round(timestamp, 3)
+	return record
+
+#This class uploads to the WU rapid fire server. WU shows the latest reading only, so while an upload is
+#in flight or the station's minimum interval hasn't passed yet, a newer reading supersedes the one waiting.
+#rtfreq tells WU how often uploads actually come, a moving average of the intervals between them
+@sinkType('wu')
+class WUSink(Sink):
+	destination = 'wu'
+	perStation = True
+
+	def __init__(self, name, sinkCfg):
+		Sink.__init__(self, name, sinkCfg)
+		self.depth = 1
+		self.policy = 'keepLatest'
+		self.rtfreq = {} # station ID -> [epoch of the latest successful upload, effective seconds between uploads]
+
+	def payload(self, station, reading):
+		payload = payloadFor(reading, 'wu')
+		# The station may be known to WU by other credentials
+		payload.update(station.wu)
+		return payload
+
+	def minInterval(self, station):
+		return station.wuMinInterval
+
+	def write(self, batch):
+		for station, timestamp, payload in batch:
+			rtfreq = self.rtfreq.get(station.id)
+			if rtfreq is None:
+				rtfreq = self.rtfreq[station.id] = [None, float(max(station.wuMinInterval, UPDATE_INTERV))]
+				metrics.gauge('wh2600_wu_rtfreq_seconds', functools.partial(operator.getitem, rtfreq, 1), station.labels)
+			payload['rtfreq'] = max(1, int(round(rtfreq[1])))
+			started = time.time()
+			if not updateWU(station, payload):
+				# An outage isn't an interval, the average starts again from the next successful upload
+				rtfreq[0] = None
+				continue
+			if rtfreq[0] is not None:
+				rtfreq[1] += RTFREQ_SMOOTHING * (started - rtfreq[0] - rtfreq[1])
+			rtfreq[0] = started
+
+@sinkType('domoticz')
+class DomoticzSink(Sink):
+	destination = 'domoticz'
+	perStation = True
+
+	def __init__(self, name, sinkCfg):
+		Sink.__init__(self, name, sinkCfg)
+		# Domoticz shows the latest state only, so a reading still waiting is replaced by a newer one
+		self.depth = 1
+		self.policy = 'keepLatest'
+
+	def write(self, batch):
+		# Every reading is offered to Domoticz, each device decides whether it's due an update
+		for station, timestamp, payload in batch:
+			updateDomoticz(station, payload)
+
+def startSinks():
+	# WU and Domoticz are always there, the archive when it's enabled, then the sinks section of config.json
+	global sinks
+	started = [WUSink('WU', {}), DomoticzSink('Domoticz', {})]
+	if cfg['system'].get('archiveEnabled', False):
+		started.append(ArchiveSink('Archive', {}))
+	for sinkCfg in cfg.get('sinks', []):
+		if not sinkCfg.get('enabled', True): continue
+		cls = SINK_TYPES.get(sinkCfg.get('type'))
+		if cls is None:
+			print 'Unknown sink type', sinkCfg.get('type'), 'in config.json, skipping it'
+			continue
+		try:
+			started.append(cls(sinkCfg.get('name', sinkCfg['type']), sinkCfg))
+		except ImportError as e:
+			print 'Sink', sinkCfg.get('name', sinkCfg['type']), 'can\'t be used:', e
+	sinks = started
+	resolutions = rollupResolutions(False)
+	for sink in sinks:
+		for resolution in sink.rollups.difference(resolutions):
+			print 'Sink', sink.name, 'wants unknown rollup resolution', resolution
+
+def updateWU(station, payload):
 	try:
-		r = requests.get(WU_UPDATE_URL, params=payload)
-	except:
-		logToDomoticz(MSG_ERROR, 'The WU server couldn\'t fulfill the request.')
-		sys.exit(0)
+		r = wuUpstream.get(payload)
+	except UpstreamError as e:
+		print e
+		if wuSpool is not None:
+			# Keep the reading, the spool replayer sends it when WU can be reached again
+			wuSpool.append(payload)
+			metrics.inc('wh2600_spooled_readings_total', station.labels)
+		# One message for an outage, not one for every reading while it lasts
+		if not station.wuFailing: station.domoticz.log(MSG_ERROR, 'The WU server couldn\'t fulfill the request.')
+		station.wuFailing = True
+		return False
 	else:
 		# everything is fine
+		if station.wuFailing: station.domoticz.log(MSG_INFO, 'The WU server can be reached again')
+		station.wuFailing = False
 		if isVerbose: print r.text
 		if isDebug: print(r.url)
+		return True
 
-def updateDomoticz(jsonQs):
-	for c in cfg['domoticz']['devices']['device']:
-		updateDomoDevice(c, jsonQs)
+#This class is an append-only file of WU readings that couldn't be delivered, one JSON record per line.
+#Records before `offset` have been replayed already and are dropped when the file is compacted.
+#The positions handed to the replayer count the bytes compacted away too, so they stay valid
+#when an append compacts the file while a record is being replayed
+class Spool(object):
 
-def updateDomoDevice(domoDevice, jsonQs):
-	if not domoDevice['enabled']:
-		return
-	# Only update if the new value differs from the device value
-	# or if the device has not been updated for a while
-	payload = dict([('type', 'devices'), ('rid', domoDevice['domoticzIdx'])])
-	r = domoticzAPI(payload)
-	#print r['result'][0]['Data'] #data
-	#print r['result'][0]['LastUpdate']
-
-	if not 'result' in r.keys():
-		errMess = 'Failure getting data for domoticz device idx: ' + str(domoDevice['domoticzIdx'])
-		print errMess
-		logToDomoticz(MSG_ERROR, errMess)
-		return
+	def __init__(self, path, maxBytes=SPOOL_MAX_BYTES):
+		self.path = path
+		self.offsetPath = path + '.offset'
+		self.maxBytes = maxBytes
+		self.lock = threading.Lock()
+		try:
+			with open(self.offsetPath) as f:
+				self.offset = int(f.read())
+		except (IOError, ValueError):
+			self.offset = 0
+		self.cutShortRecord()
+		self.file = open(self.path, 'ab') # Buffered, appending a record is just a memory copy most of the time
+		self.size = self.file.tell()
+		if self.offset > self.size: self.offset = 0
+		self.base = 0 # Bytes compacted away since startup
 
-	# Now, looking for a reason to update the sensor
-	# Does the Domotic's sensor need an update in order not to time out?
-	sensorTimedOut = False
-	if 'HaveTimeout' in r['result'][0]:
-		if (r['result'][0]['HaveTimeout'] and ((datetime.now() - datetime.strptime(r['result'][0]['LastUpdate'], '%Y-%m-%d %H:%M:%S')).seconds >= 3000)):
-			sensorTimedOut = True
+	def cutShortRecord(self):
+		# A crash may have left the last record without its end of line, the next record would be appended to
+		# it and both skipped as damaged. The file is cut back to the end of the last complete record
+		try:
+			f = open(self.path, 'r+b')
+		except IOError:
+			return
+		with f:
+			f.seek(0, os.SEEK_END)
+			end = f.tell()
+			while end > 0:
+				start = max(0, end - 4096)
+				f.seek(start)
+				newline = f.read(end - start).rfind('\n')
+				if newline >= 0:
+					end = start + newline + 1
+					break
+				end = start
+			if end != f.tell():
+				print 'Dropping a record cut short at the end of the WU spool'
+				f.truncate(end)
 
-	# Checking if the 'Indoor Temp + Humidity' device needs an update
+	def append(self, payload):
+		record = json.dumps(payload) + '\n'
+		with self.lock:
+			self.file.write(record)
+			self.size += len(record)
+			if self.size > self.maxBytes:
+				self.compact()
 
-	if ('indoortempf' in jsonQs) and domoDevice['categoryName'] == 'Indoor Temp + Humidity' and domoDevice['domoticzSensorType'] == 82:
-		if cfg['domoticz']['unitsOfTemperature']  == 'Celcius':
-			reportedTemp = round(temp_c(jsonQs['indoortempf']), 1)
-		else:
-			reportedTemp = round(jsonQs['indoortempf'], 1)
-		reportedHum = jsonQs['indoorhumidity']
-		domoTemp = round(r['result'][0]['Temp'], 1)
-		domoHum = round(r['result'][0]['Humidity'], 1)
-		if reportedTemp != domoTemp or reportedHum != domoHum or sensorTimedOut:
-			if isVerbose: print 'Updating the Domoticz Indoor Temp + Humidity device to', reportedTemp, ';', reportedHum
-			if isVerbose and sensorTimedOut: print '<sensorTimedOut>'
-			payload = dict([('type', 'command'), ('param', 'udevice'), ('idx', domoDevice['domoticzIdx']), \
-                  ('nvalue', 0), ('svalue', str(reportedTemp)+';'+str(reportedHum)+';'+str(getHumStat(reportedHum)))])
-			r = domoticzAPI(payload)
-
-	# Checking if the 'Outdoor Temp + Humidity' device needs an update
-	elif domoDevice['categoryName'] == 'Outdoor Temp + Humidity' and domoDevice['domoticzSensorType'] == 82:
-		if cfg['domoticz']['unitsOfTemperature']  == 'Celcius':
-			reportedTemp = round(temp_c(jsonQs['tempf']), 1)
+	def flush(self):
+		with self.lock:
+			self.file.flush()
+
+	def pending(self):
+		return self.offset < self.size
+
+	def next(self):
+		# The oldest record not replayed yet and the position where the record after it starts
+		with self.lock:
+			self.file.flush()
+			position = self.base + self.offset
+			with open(self.path, 'rb') as f:
+				f.seek(self.offset)
+				line = f.readline()
+		if not line.endswith('\n'):
+			return None, position
+		try:
+			return json.loads(line), position + len(line)
+		except ValueError:
+			print 'Skipping a damaged record in the WU spool'
+			return None, position + len(line)
+
+	def commit(self, position):
+		# Remember that everything up to position has been replayed. If the file was compacted meanwhile
+		# the position is moved along, unless the record was given up by the compaction already
+		with self.lock:
+			offset = position - self.base
+			if offset <= self.offset: return
+			self.offset = offset
+			if self.offset >= self.size or self.offset > self.maxBytes / 2:
+				self.compact()
+			else:
+				self.saveOffset()
+
+	def saveOffset(self):
+		with open(self.offsetPath + '.tmp', 'w') as f:
+			f.write(str(self.offset))
+		os.rename(self.offsetPath + '.tmp', self.offsetPath)
+
+	def compact(self):
+		# Rewrite the spool without the replayed records. If it's still too big the oldest
+		# readings are given up, bringing the spool down to three quarters of its maximum size
+		self.file.flush()
+		with open(self.path, 'rb') as f:
+			f.seek(self.offset)
+			records = f.readlines()
+		keep = self.maxBytes * 3 / 4
+		size = sum(len(r) for r in records)
+		self.base += self.offset
+		while records and size > keep:
+			dropped = len(records.pop(0))
+			size -= dropped
+			self.base += dropped
+		self.file.close()
+		with open(self.path + '.tmp', 'wb') as f:
+			f.writelines(records)
+		os.rename(self.path + '.tmp', self.path)
+		self.file = open(self.path, 'ab')
+		self.size = size
+		self.offset = 0
+		self.saveOffset()
+
+#This class sends the spooled WU readings, oldest first, at a limited rate
+class SpoolReplayer(threading.Thread):
+
+	def __init__(self, spool, rate=SPOOL_REPLAY_RATE):
+		threading.Thread.__init__(self, name='WU spool replayer')
+		self.daemon = True
+		self.spool = spool
+		self.interval = 1.0 / rate
+
+	def run(self):
+		lastFlush = time.time()
+		while True:
+			if not self.spool.pending():
+				time.sleep(1)
+				if time.time() - lastFlush >= SPOOL_FLUSH_INTERV:
+					self.spool.flush()
+					lastFlush = time.time()
+				continue
+			payload, position = self.spool.next()
+			if payload is not None and not self.replay(payload):
+				# WU is still out of reach, wait for the upstream hold off before trying again
+				time.sleep(max(self.interval, wuUpstream.holdOffUntil - time.time()))
+				continue
+			self.spool.commit(position)
+			time.sleep(self.interval)
+
+	def replay(self, payload):
+		# Old readings go to the regular upload server, not to the rapid fire server
+		payload = dict(payload)
+		payload.pop('realtime', None)
+		payload.pop('rtfreq', None)
+		try:
+			r = wuUpstream.get(payload, url=WU_REPLAY_URL)
+		except UpstreamError as e:
+			if isVerbose: print 'Replaying spooled WU reading failed:', e
+			return False
+		if isVerbose: print 'Replayed spooled WU reading from', payload.get('dateutc'), ':', r.text.strip()
+		metrics.inc('wh2600_replayed_readings_total')
+		return True
+
+def startSpool():
+	global wuSpool
+	path = cfg['system'].get('wuSpoolPath', os.path.join(cfg['system']['tmpFolder'], SPOOL_FILE))
+	wuSpool = Spool(path, cfg['system'].get('wuSpoolMaxBytes', SPOOL_MAX_BYTES))
+	metrics.gauge('wh2600_spool_bytes', lambda: wuSpool.size - wuSpool.offset)
+	SpoolReplayer(wuSpool, cfg['system'].get('wuSpoolReplayRate', SPOOL_REPLAY_RATE)).start()
+
+#This class saves the rolling wind windows, open rollups and counters of every station to a small binary file on a
+#background thread. The file is written next to the old one and renamed, so it's always complete
+class Checkpoint(threading.Thread):
+
+	def __init__(self, path, interval=CHECKPOINT_INTERV, maxAge=CHECKPOINT_MAX_AGE):
+		threading.Thread.__init__(self, name='Checkpoint writer')
+		self.daemon = True
+		self.path = path
+		self.interval = interval
+		self.maxAge = maxAge
+		self.lock = threading.Lock()
+		self.saved = self.load() # station ID -> (latest reading epoch, runs, {window name: samples}) not restored yet
+
+	def run(self):
+		while True:
+			time.sleep(self.interval)
+			self.save()
+
+	def save(self):
+		# Called from the checkpoint thread and the SIGTERM handler, neither may die on a full or read-only disk
+		try:
+			self.write()
+		except Exception:
+			print 'Failed to write the checkpoint file', self.path, ':', sys.exc_info()[1]
+
+	def write(self):
+		with stationsLock:
+			current = stations.values()
+		states = {}
+		for station in current:
+			with station.lock:
+				if station.lastReading is None: continue
+				windows = dict((name, zip(w.ordered(w.speed), w.ordered(w.direction), w.ordered(w.gust))) \
+						for name, w in station.windStats.windows.items())
+				rollups = station.rollups
+				buckets = dict((name, bucket.state()) for name, bucket in rollups.buckets.items()) if rollups else {}
+				states[station.id] = (station.lastReading, station.runs, windows, station.meteo.state(), buckets)
+		with self.lock:
+			# Stations that haven't reported since the restart keep their state while it's recent enough
+			for stationId, state in self.saved.items():
+				if stationId not in states and time.time() - state[0] <= self.maxAge:
+					states[stationId] = state
+			with open(self.path + '.tmp', 'wb') as f:
+				f.write(packCheckpoint(states))
+			os.rename(self.path + '.tmp', self.path)
+
+	def load(self):
+		try:
+			with open(self.path, 'rb') as f:
+				data = f.read()
+		except IOError:
+			return {}
+		try:
+			return unpackCheckpoint(data)
+		except (struct.error, ValueError):
+			print 'Ignoring the damaged or outdated checkpoint file', self.path
+			return {}
+
+	def restore(self, station):
+		with self.lock:
+			state = self.saved.pop(station.id, None)
+		if state is None: return
+		lastReading, runs, windows, meteo, buckets = state
+		if time.time() - lastReading > self.maxAge:
+			if isVerbose: print 'Checkpointed state of station', station.id, 'is too old to be restored'
+			return
+		station.lastReading = lastReading
+		station.runs = runs
+		for name, samples in windows.items():
+			if name in station.windStats.windows and samples:
+				station.windStats[name].restore(samples)
+		station.meteo.restore(meteo)
+		if station.rollups is not None:
+			station.rollups.restore(lastReading, \
+					dict((name, RollupBucket(bucketState[0]).restore(bucketState)) for name, bucketState in buckets.items()))
+		if isVerbose: print 'Restored the wind windows of station', station.id, 'from', time.ctime(lastReading)
+
+# A checkpoint file is the magic string, the time it was written and the number of stations. Then for each
+# station its ID, latest reading epoch, runs and number of windows, and for each window its name, number of
+# samples and the speeds, directions and gusts of the samples, oldest first. Directions are doubles like the
+# rest, a station may report any number. Then the latest daily rain (NaN if none), the number of pressures
+# and their epochs and hPa, the number of rain samples and their epochs and hundredths of inches, the number
+# of open rollup buckets and for each its resolution name, start, count, partial flag, wind sums, rain and
+# number of fields, and for each field its name, minimum, maximum, sum, latest value and number of values.
+# Strings are preceded by their length
+def packCheckpoint(states):
+	parts = [struct.pack('<8sdI', CHECKPOINT_MAGIC, time.time(), len(states))]
+	for stationId, (lastReading, runs, windows, (lastDailyRain, pressures, rain), buckets) in states.items():
+		parts.append(packString(stationId))
+		parts.append(struct.pack('<dII', lastReading, runs, len(windows)))
+		for name, samples in windows.items():
+			speeds, directions, gusts = zip(*samples) if samples else ((), (), ())
+			n = len(samples)
+			parts.append(packString(name))
+			parts.append(struct.pack('<I%dd' % (3 * n), n, *(speeds + directions + gusts)))
+		epochs, values = zip(*pressures) if pressures else ((), ())
+		n = len(pressures)
+		parts.append(struct.pack('<dI%dd' % (2 * n), NAN if lastDailyRain is None else lastDailyRain, n, *(epochs + values)))
+		epochs, values = zip(*rain) if rain else ((), ())
+		n = len(rain)
+		parts.append(struct.pack('<I%dd%di' % (n, n), n, *(epochs + values)))
+		parts.append(struct.pack('<I', len(buckets)))
+		for name, (start, count, partial, windEast, windNorth, windCount, rain, stats) in buckets.items():
+			parts.append(packString(name))
+			parts.append(struct.pack('<dI?ddIdI', start, count, partial, windEast, windNorth, windCount, rain, len(stats)))
+			for field, (minimum, maximum, total, latest, n) in stats.items():
+				parts.append(packString(field))
+				parts.append(struct.pack('<ddddI', minimum, maximum, total, latest, n))
+	return ''.join(parts)
+
+def unpackCheckpoint(data):
+	magic, written, count = struct.unpack_from('<8sdI', data)
+	if magic != CHECKPOINT_MAGIC: raise ValueError('not a checkpoint file')
+	offset = struct.calcsize('<8sdI')
+	states = {}
+	for i in range(count):
+		stationId, offset = unpackString(data, offset)
+		lastReading, runs, windowCount = struct.unpack_from('<dII', data, offset)
+		offset += struct.calcsize('<dII')
+		windows = {}
+		for j in range(windowCount):
+			name, offset = unpackString(data, offset)
+			n, = struct.unpack_from('<I', data, offset)
+			fmt = '<I%dd' % (3 * n)
+			values = struct.unpack_from(fmt, data, offset)[1:]
+			offset += struct.calcsize(fmt)
+			windows[name] = zip(values[:n], values[n:2*n], values[2*n:])
+		lastDailyRain, n = struct.unpack_from('<dI', data, offset)
+		fmt = '<dI%dd' % (2 * n)
+		values = struct.unpack_from(fmt, data, offset)[2:]
+		offset += struct.calcsize(fmt)
+		pressures = zip(values[:n], values[n:])
+		n, = struct.unpack_from('<I', data, offset)
+		fmt = '<I%dd%di' % (n, n)
+		values = struct.unpack_from(fmt, data, offset)[1:]
+		offset += struct.calcsize(fmt)
+		rain = zip(values[:n], values[n:])
+		bucketCount, = struct.unpack_from('<I', data, offset)
+		offset += 4
+		buckets = {}
+		for j in range(bucketCount):
+			name, offset = unpackString(data, offset)
+			bucket = struct.unpack_from('<dI?ddIdI', data, offset)
+			offset += struct.calcsize('<dI?ddIdI')
+			stats = {}
+			for k in range(bucket[-1]):
+				field, offset = unpackString(data, offset)
+				minimum, maximum, total, latest, n = struct.unpack_from('<ddddI', data, offset)
+				offset += struct.calcsize('<ddddI')
+				# Whole number fields stay whole numbers in the summaries
+				kind = int if field in FIELDS and FIELDS[field][1] is int else float
+				stats[field] = [kind(minimum), kind(maximum), kind(total), kind(latest), n]
+			buckets[name] = (int(bucket[0]),) + bucket[1:-1] + (stats,)
+		states[stationId] = (lastReading, runs, windows, (None if math.isnan(lastDailyRain) else lastDailyRain, pressures, rain), buckets)
+	return states
+
+def packString(value):
+	# Station IDs and window names from config.json are unicode
+	if isinstance(value, unicode): value = value.encode('utf-8')
+	return struct.pack('<H', len(value)) + value
+
+def unpackString(data, offset):
+	length, = struct.unpack_from('<H', data, offset)
+	offset += 2
+	if offset + length > len(data): raise ValueError('checkpoint file cut short')
+	return data[offset:offset + length], offset + length
+
+def startCheckpoint():
+	global checkpoint
+	path = cfg['system'].get('checkpointPath', os.path.join(cfg['system']['tmpFolder'], CHECKPOINT_FILE))
+	checkpoint = Checkpoint(path, cfg['system'].get('checkpointInterval', CHECKPOINT_INTERV), \
+			cfg['system'].get('checkpointMaxAge', CHECKPOINT_MAX_AGE))
+	checkpoint.start()
+
+def saveCheckpoint(signum=None, frame=None):
+	# Also the SIGTERM handler, the init script stops the daemon that way
+	if checkpoint is not None: checkpoint.save()
+	if signum is not None: sys.exit(0)
+
+#This class appends every reading to a columnar archive, <archivePath>/<station ID>/<YYYY-MM-DD>/<field>.f4,
+#one file per field and day so that a range of one field can be read with a single memory map
+class Archive(object):
+
+	def __init__(self, path, flushInterval=ARCHIVE_FLUSH_INTERV):
+		self.path = path
+		self.flushInterval = flushInterval
+		self.files = {} # station ID -> (day, {column: file})
+		self.lastFlush = time.time()
+
+	def store(self, reading):
+		stationId, timestamp, jsonQs = reading
+		if not STATION_ID.match(stationId):
+			# The ID is a folder name, anything else than letters, digits, _ or - could lead out of the archive
+			print 'Not archiving the reading of station ID', repr(stationId)
+			return
+		day = time.strftime('%Y-%m-%d', time.gmtime(timestamp))
+		if stationId not in self.files or self.files[stationId][0] != day:
+			self.close(stationId)
+			self.files[stationId] = (day, self.open(stationId, day))
+		files = self.files[stationId][1]
+		# The whole row is packed before any of it is written, a value that doesn't pack mustn't leave the columns uneven
+		row = [('time', struct.pack('<I', int(timestamp)))]
+		for field in ARCHIVE_FIELDS:
+			value = jsonQs.get(field)
+			if not isinstance(value, (int, float)) or abs(value) > FLOAT32_MAX: value = NAN
+			row.append((field, struct.pack('<f', value)))
+		for field, packed in row:
+			files[field].write(packed)
+		if time.time() - self.lastFlush >= self.flushInterval:
+			self.flush()
+
+	def open(self, stationId, day):
+		folder = os.path.join(self.path, stationId, day)
+		if not os.path.isdir(folder): os.makedirs(folder)
+		files = {'time': open(os.path.join(folder, 'time.u4'), 'ab')}
+		for field in ARCHIVE_FIELDS:
+			files[field] = open(os.path.join(folder, field + '.f4'), 'ab')
+		# A crash may have left the columns uneven, only the rows every column holds are kept.
+		# Padding a short column would make up zeros where nothing was measured
+		rows = min(f.tell() / 4 for f in files.values())
+		for f in files.values():
+			if f.tell() != rows * 4: f.truncate(rows * 4)
+		return files
+
+	def close(self, stationId):
+		if stationId in self.files:
+			for f in self.files.pop(stationId)[1].values():
+				f.close()
+
+	def flush(self):
+		for day, files in self.files.values():
+			for f in files.values():
+				f.flush()
+		self.lastFlush = time.time()
+
+@sinkType('archive')
+class ArchiveSink(Sink):
+	destination = 'archive'
+	beforeWind = True # The archive keeps the wind direction as measured, not smoothened
+
+	def __init__(self, name, sinkCfg):
+		Sink.__init__(self, name, sinkCfg)
+		self.archive = Archive(sinkCfg.get('path', archivePath()), \
+				sinkCfg.get('flushInterval', cfg['system'].get('archiveFlushInterval', ARCHIVE_FLUSH_INTERV)))
+
+	def write(self, batch):
+		for station, timestamp, payload in batch:
+			self.archive.store((station.id, timestamp, payload))
+
+def archivePath():
+	return cfg['system'].get('archivePath', sys.path[0] + '/archive')
+
+def archiveQuery(stationId, start, end, fields=ARCHIVE_FIELDS, path=None):
+	"""Readings of a station from start up to end (UTC datetimes) as a dict of NumPy arrays,
+	one per field plus 'time' in UTC epoch seconds"""
+	if not STATION_ID.match(stationId): raise ValueError('Invalid station ID ' + repr(stationId))
+	import numpy
+	path = path or archivePath()
+	startTime = calendar.timegm(start.utctimetuple())
+	endTime = calendar.timegm(end.utctimetuple())
+	columns = dict((field, []) for field in ('time',) + tuple(fields))
+	for dayTime in range(startTime - startTime % 86400, endTime, 86400):
+		folder = os.path.join(path, stationId, time.strftime('%Y-%m-%d', time.gmtime(dayTime)))
+		timePath = os.path.join(folder, 'time.u4')
+		if not os.path.exists(timePath) or os.path.getsize(timePath) == 0: continue
+		t = numpy.memmap(timePath, dtype='<u4', mode='r')
+		# The writer may be ahead with some columns, only complete rows count
+		rows = min([len(t)] + [os.path.getsize(os.path.join(folder, field + '.f4')) / 4 for field in fields])
+		first, last = numpy.searchsorted(t[:rows], [startTime, endTime])
+		if first == last: continue
+		columns['time'].append(numpy.array(t[first:last]))
+		for field in fields:
+			columns[field].append(numpy.array(numpy.memmap(os.path.join(folder, field + '.f4'), dtype='<f4', mode='r', shape=(rows,))[first:last]))
+	return dict((field, numpy.concatenate(parts) if parts else numpy.array([], dtype='<u4' if field == 'time' else '<f4')) \
+			for field, parts in columns.items())
+
+def printArchive(stationId, start, end, fields):
+	# CSV of the archived readings, e.g. for a spreadsheet
+	data = archiveQuery(stationId, start, end, fields)
+	print ','.join(('dateutc',) + tuple(fields))
+	for i in range(len(data['time'])):
+		row = [time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(data['time'][i]))]
+		row += ['' if math.isnan(data[field][i]) else '%g' % data[field][i] for field in fields]
+		print ','.join(row)
+
+def parseDate(value):
+	for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+		try:
+			return datetime.strptime(value, fmt)
+		except ValueError:
+			pass
+	print 'Invalid date \'' + value + '\', use YYYY-MM-DD[ HH:MM[:SS]] (UTC)'
+	sys.exit(2)
+
+#This class publishes every reading as a JSON object to an MQTT broker, with paho-mqtt.
+#The client reconnects on its own, readings published while the broker is away are lost
+@sinkType('mqtt')
+class MQTTSink(Sink):
+
+	def __init__(self, name, sinkCfg):
+		import paho.mqtt.client as mqtt # Only needed when there is an MQTT sink
+		Sink.__init__(self, name, sinkCfg)
+		self.mqtt = mqtt
+		self.topic = sinkCfg.get('topic', MQTT_TOPIC)
+		self.rollupTopic = sinkCfg.get('rollupTopic', MQTT_ROLLUP_TOPIC)
+		self.qos = sinkCfg.get('qos', 0)
+		self.retain = sinkCfg.get('retain', False)
+		self.client = mqtt.Client(client_id=sinkCfg.get('clientId', ''))
+		if sinkCfg.get('userName'):
+			self.client.username_pw_set(sinkCfg['userName'], sinkCfg.get('passWord'))
+		# Messages the client holds back for the broker are bounded like the queue of the worker
+		self.client.max_queued_messages_set(self.depth)
+		self.client.connect_async(sinkCfg.get('hostName', 'localhost'), sinkCfg.get('portNumber', 1883), MQTT_KEEPALIVE)
+		self.client.loop_start()
+
+	def write(self, batch):
+		for station, timestamp, payload in batch:
+			if 'resolution' in payload:
+				topic = self.rollupTopic.format(station=station.id, resolution=payload['resolution'])
+			else:
+				topic = self.topic.format(station=station.id)
+			info = self.client.publish(topic, json.dumps(sinkRecord(station, timestamp, payload), sort_keys=True), \
+					self.qos, self.retain)
+			if info.rc != self.mqtt.MQTT_ERR_SUCCESS:
+				raise UpstreamError('MQTT publish failed: ' + self.mqtt.error_string(info.rc))
+
+#This class writes readings to InfluxDB in line protocol, in batches to the HTTP /write endpoint
+#when url is set, otherwise as UDP datagrams to hostName:portNumber
+@sinkType('influxdb')
+class InfluxDBSink(Sink):
+	batchSize = SINK_BATCH_SIZE
+
+	def __init__(self, name, sinkCfg):
+		Sink.__init__(self, name, sinkCfg)
+		self.measurement = escapeInflux(sinkCfg.get('measurement', INFLUXDB_MEASUREMENT))
+		self.upstream = None
+		if sinkCfg.get('url'):
+			auth = sinkCfg.get('httpBasicAuth')
+			self.upstream = Upstream(name, sinkCfg['url'], auth=(auth['userName'], auth['passWord']) if auth else None)
+			self.params = dict(db=sinkCfg.get('database', 'weather'))
 		else:
-			reportedTemp = round(jsonQs['tempf'], 1)
-		reportedHum = int(jsonQs['humidity'])
-		domoTemp = round(r['result'][0]['Temp'], 1)
-		domoHum = round(r['result'][0]['Humidity'], 1)
-		if reportedTemp != domoTemp or reportedHum != domoHum or sensorTimedOut:
-			if isVerbose: print 'Updating the Domoticz Outdoor Temp + Humidity device to', reportedTemp, ';', reportedHum
-			if isVerbose and sensorTimedOut: print '<sensorTimedOut>'
-			payload = dict([('type', 'command'), ('param', 'udevice'), ('idx', domoDevice['domoticzIdx']), \
-                  ('nvalue', 0), ('svalue', str(reportedTemp)+';'+str(reportedHum)+';'+str(getHumStat(reportedHum)))])
-			r = domoticzAPI(payload)
-
-	# Checking if the 'Barometer' device needs an update
-	elif domoDevice['categoryName'] == 'Barometer' and domoDevice['domoticzSensorType'] == 1:
-		reportedValue = round(mbar(jsonQs['baromin']), 0)
-		domoValue = round(r['result'][0]['Barometer'], 0)
-		if reportedValue != domoValue or sensorTimedOut:
-			if isVerbose: print 'Updating the Domoticz Barometer device to', reportedValue
-			if isVerbose and sensorTimedOut: print '<sensorTimedOut>'
-			payload = dict([('type', 'command'), ('param', 'udevice'), ('idx', domoDevice['domoticzIdx']), \
-                  ('nvalue', 0), ('svalue', str(reportedValue)+';'+str(getBaroForecast(reportedValue)))])
-			r = domoticzAPI(payload)
-
-	# Checking if the 'Rain' device needs an update
-	elif domoDevice['categoryName'] == 'Rain' and domoDevice['domoticzSensorType'] == 85:
-		# Convert inches of rain to mm
-		reportedValue = round(mm(jsonQs['rainin']) * 100, 0)
-		reportedValueYear = round(mm(jsonQs['yearlyrainin']), 0)
+			self.address = (sinkCfg.get('hostName', 'localhost'), sinkCfg.get('portNumber', 8089))
+			self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+	def write(self, batch):
+		lines = [self.line(station, timestamp, payload) for station, timestamp, payload in batch]
+		if self.upstream is not None:
+			r = self.upstream.request('POST', self.params, data='\n'.join(lines) + '\n')
+			if r.status_code >= 300:
+				raise UpstreamError('InfluxDB answered ' + str(r.status_code) + ': ' + r.text.strip())
+			return
+		datagram = ''
+		for line in lines:
+			if datagram and len(datagram) + len(line) >= UDP_MAX_DATAGRAM:
+				self.socket.sendto(datagram, self.address)
+				datagram = ''
+			datagram += line + '\n'
+		self.socket.sendto(datagram, self.address)
+
+	def line(self, station, timestamp, payload):
+		# e.g. wh2600,station=ID humidity=62i,tempf=19.0 1500000000000000000, integers have an i suffix.
+		# Rollups are tagged with their resolution
+		tags = ',station=' + escapeInflux(station.id)
+		if 'resolution' in payload: tags += ',resolution=' + escapeInflux(payload['resolution'])
+		fields = ','.join(key + '=' + (str(value) + 'i' if isinstance(value, (int, long)) else repr(float(value))) \
+				for key, value in sorted(payload.items()) if key != 'resolution')
+		return self.measurement + tags + ' ' + fields + ' ' + str(int(timestamp * 1e9))
+
+def escapeInflux(value):
+	# Commas, spaces and equal signs are special in measurement names and tag values
+	return str(value).replace('\\', '\\\\').replace(',', '\\,').replace(' ', '\\ ').replace('=', '\\=')
+
+#This class appends every reading as a JSON object on a line of its own to a local file. The path may hold
+#strftime codes for the UTC time of the reading, e.g. /home/pi/wh2600-%Y-%m-%d.jsonl starts a new file every day
+@sinkType('jsonl')
+class JSONLinesSink(Sink):
+	batchSize = SINK_BATCH_SIZE
+
+	def __init__(self, name, sinkCfg):
+		Sink.__init__(self, name, sinkCfg)
+		self.path = sinkCfg.get('path', os.path.join(cfg['system']['tmpFolder'], 'interceptWH2600.jsonl'))
+		self.file = None
+		self.filePath = None
+
+	def write(self, batch):
+		for station, timestamp, payload in batch:
+			path = time.strftime(self.path, time.gmtime(timestamp))
+			if path != self.filePath:
+				if self.file is not None: self.file.close()
+				folder = os.path.dirname(path)
+				if folder and not os.path.isdir(folder): os.makedirs(folder)
+				self.file = open(path, 'ab')
+				self.filePath = path
+			self.file.write(json.dumps(sinkRecord(station, timestamp, payload), sort_keys=True) + '\n')
+		self.file.flush()
+
+def updateDomoticz(station, jsonQs):
+	# Collect the updates of the devices that are due one and send them all at once
+	domo = station.domoticz
+	now = time.time()
+	writes = []
+	for updater in station.domoUpdaters:
+		started = time.time()
+		try:
+			write = updater.due(jsonQs, now)
+			if write is not None: writes.append(write)
+		except KeyError as e:
+			# The station didn't report what this device shows
+			if isVerbose: print 'No', e, 'in the reading, not updating the Domoticz', updater.name, 'device'
+		metrics.observe('wh2600_domoticz_device_seconds', time.time() - started, updater.labels)
+	if writes: domo.sendUpdates(writes)
+
+# Domoticz device updaters by (categoryName, domoticzSensorType)
+DOMO_UPDATERS = {}
+
+def domoUpdater(categoryName, sensorType):
+	# Class decorator that adds a device updater to the registry
+	def register(cls):
+		DOMO_UPDATERS[(categoryName, sensorType)] = cls
+		return cls
+	return register
+
+def compileDomoDevices(domo, domoCfg):
+	# The device list of a station's Domoticz settings turned into updaters, once per station
+	updaters = []
+	for domoDevice in domoCfg['devices']['device']:
+		if not domoDevice['enabled']: continue
+		cls = DOMO_UPDATERS.get((domoDevice['categoryName'], domoDevice['domoticzSensorType']))
+		if cls is None:
+			print 'Unknown Domoticz device', domoDevice['categoryName'], 'of type', domoDevice['domoticzSensorType'], ', ignoring it'
+			continue
+		updaters.append(cls(domo, domoCfg, domoDevice))
+	return updaters
+
+#This class is the base of the Domoticz device updaters. The subclasses tell how to pick
+#the values out of a reading and the device, how to format them for Domoticz and how often
+#the device may be updated
+class DomoUpdater(object):
+	minInterval = 0 # Default minimum seconds between two updates of the device
+
+	def __init__(self, domo, domoCfg, domoDevice):
+		self.domo = domo
+		self.idx = domoDevice['domoticzIdx']
+		self.name = domoDevice['categoryName']
+		self.labels = (('device', self.name),)
+		# Changes up to the deadband are not worth an update, 0 updates on any change
+		self.deadband = domoDevice.get('deadband', 0)
+		self.minInterval = domoDevice.get('minInterval', self.minInterval)
+		self.maxInterval = domoDevice.get('maxInterval', DOMO_MAX_INTERV)
+		self.celsius = domoCfg['unitsOfTemperature'] == 'Celcius'
+		self.lastPush = None # When the device was last updated, as epoch seconds
+		self.missing = False # Whether Domoticz was found not to know the device
+
+	def due(self, jsonQs, now):
+		# The (updater, nvalue, svalue, shadow) update to send, or None if the device is fine as it is.
+		# Update if the new value differs from the device value and the device wasn't updated too recently,
+		# or if the device has not been updated for so long that Domoticz would see it as timed out.
+		# The device value is taken from the shadow cache, not read back from Domoticz
+		reported = self.reported(jsonQs)
+		device = self.domo.getDevice(self.idx)
+		if device is None:
+			# A wrong or unused idx is worth one message, not one for every reading
+			if self.domo.fetched is not None and not self.missing:
+				errMess = 'Failure getting data for domoticz device idx: ' + str(self.idx)
+				print errMess
+				self.domo.log(MSG_ERROR, errMess)
+				self.missing = True
+			return None
+		self.missing = False
+		if self.lastPush is None:
+			try:
+				self.lastPush = time.mktime(time.strptime(device['LastUpdate'], '%Y-%m-%d %H:%M:%S'))
+			except (KeyError, ValueError):
+				self.lastPush = 0
+		age = now - self.lastPush
+		sensorTimedOut = age >= self.maxInterval
+		if not sensorTimedOut and (age < self.minInterval or not self.changed(reported, device)):
+			return None
+		nvalue, svalue, shadow = self.format(reported)
+		if isVerbose: print 'Updating the Domoticz', self.name, 'device to', svalue
+		if isVerbose and sensorTimedOut: print '<sensorTimedOut>'
+		metrics.inc('wh2600_domoticz_writes_total', self.labels + (('reason', 'timeout' if sensorTimedOut else 'change'),))
+		return self, nvalue, svalue, shadow
+
+	def changed(self, reported, device):
+		current = self.current(device)
+		for r, c in zip(reported, current):
+			if abs(r - c) > self.deadband: return True
+		return False
+
+#This class updates a Temp + Humidity device from the given reading fields
+class TempHumUpdater(DomoUpdater):
+	minInterval = 60
+	tempField = None
+	tempFieldC = None
+	humField = None
+
+	def reported(self, jsonQs):
+		return round(jsonQs[self.tempFieldC if self.celsius else self.tempField], 1), int(jsonQs[self.humField])
+
+	def current(self, device):
+		return round(device['Temp'], 1), round(device['Humidity'], 1)
+
+	def format(self, reported):
+		temp, hum = reported
+		return 0, str(temp)+';'+str(hum)+';'+str(getHumStat(hum)), dict(Temp=temp, Humidity=hum)
+
+@domoUpdater('Indoor Temp + Humidity', 82)
+class IndoorTempHumUpdater(TempHumUpdater):
+	tempField = 'indoortempf'
+	tempFieldC = 'indoortempc'
+	humField = 'indoorhumidity'
+
+@domoUpdater('Outdoor Temp + Humidity', 82)
+class OutdoorTempHumUpdater(TempHumUpdater):
+	tempField = 'tempf'
+	tempFieldC = 'tempc'
+	humField = 'humidity'
+
+@domoUpdater('Barometer', 1)
+class BarometerUpdater(DomoUpdater):
+	minInterval = 300 # Pressure changes slowly, the forecast doesn't need every step
+
+	def reported(self, jsonQs):
+		return round(jsonQs['baromhpa'], 0), jsonQs.get('baroforecast', BARO_UNKNOWN)
+
+	def current(self, device):
+		return round(device['Barometer'], 0), device.get('Forecast', BARO_UNKNOWN)
+
+	def changed(self, reported, device):
+		# Without enough pressure history there is no forecast yet, which is no reason to replace the device's
+		if reported[1] == BARO_UNKNOWN: reported = reported[0], self.current(device)[1]
+		return DomoUpdater.changed(self, reported, device)
+
+	def format(self, reported):
+		return 0, str(reported[0])+';'+str(reported[1]), dict(Barometer=reported[0], Forecast=reported[1])
+
+@domoUpdater('Rain', 85)
+class RainUpdater(DomoUpdater):
+
+	def reported(self, jsonQs):
+		# Domoticz takes the rate in hundredths of mm per hour
+		return round(jsonQs['rainratemm'] * 100, 0), round(jsonQs['yearlyrainmm'], 0)
+
+	def changed(self, reported, device):
+		# Only the yearly total counts, the rate follows it
 		try:
-			domoValue = round(float(r['result'][0]['Data'].split(';')[1]), 0)
+			domoValue = round(float(device['Data'].split(';')[1]), 0)
 		except:
 			domoValue = 0
-		if reportedValueYear != domoValue or sensorTimedOut:
-			if isVerbose: print 'Updating the Domoticz Rain device from ', domoValue, 'to', reportedValue, ';', reportedValueYear
-			if isVerbose and sensorTimedOut: print '<sensorTimedOut>'
-			payload = dict([('type', 'command'), ('param', 'udevice'), ('idx', domoDevice['domoticzIdx']), \
-					('nvalue', 0), ('svalue', str(reportedValue)+';'+str(reportedValueYear))])
-			r = domoticzAPI(payload)
-
-	# Updating the 'Wind' device. No need to check the current value, it's likely to be different anyway
-	elif domoDevice['categoryName'] == 'Wind' and domoDevice['domoticzSensorType'] == 86:
+		return abs(reported[1] - domoValue) > self.deadband
+
+	def format(self, reported):
+		svalue = str(reported[0])+';'+str(reported[1])
+		return 0, svalue, dict(Data=svalue)
+
+@domoUpdater('Wind', 86)
+class WindUpdater(DomoUpdater):
+	minInterval = 60 # Always changing, so updated at this rate
+
+	def reported(self, jsonQs):
 		# First build the data string
 		dataString = str(jsonQs['winddir_avg10m'])
 		dataString += ';' + str(degToCompass(jsonQs['winddir_avg10m']))
-		dataString += ';' + str(round(ms(jsonQs['windspdmph_avg10m']) * 10 , 0))
-		dataString += ';' + str(round(ms(jsonQs['windgustmph_10m']) * 10 , 0))
-		dataString += ';' + str(round(temp_c(jsonQs['tempf']), 1))
-		dataString += ';' + str(round(wind_chill(temp_c(jsonQs['tempf']), jsonQs['windspdmph_avg10m']), 1))
+		dataString += ';' + str(round(jsonQs['windspdms_avg10m'] * 10 , 0))
+		dataString += ';' + str(round(jsonQs['windgustms_10m'] * 10 , 0))
+		dataString += ';' + str(round(jsonQs['tempc'], 1))
+		dataString += ';' + str(round(jsonQs['windchillc'], 1))
 		if isDebug: print 'Wind data string: ', dataString # E.g. '4;N;30.0;44.0;-6.6;-14.3'
-		if isVerbose: print 'Updating the Domoticz Wind device to', dataString
-		payload = dict([('type', 'command'), ('param', 'udevice'), ('idx', domoDevice['domoticzIdx']), \
-				('nvalue', 0), ('svalue', dataString)])
-		r = domoticzAPI(payload)
-
-
-	# Checking if the 'UV' device needs an update
-	elif domoDevice['categoryName'] == 'UV' and domoDevice['domoticzSensorType'] == 87:
-		reportedValue = jsonQs['UV']
-		domoValue = int(r['result'][0]['UVI'])
-		if reportedValue != domoValue or sensorTimedOut:
-			if isVerbose: print 'Updating the Domoticz UV device to', reportedValue
-			if isVerbose and sensorTimedOut: print '<sensorTimedOut>'
-			payload = dict([('type', 'command'), ('param', 'udevice'), ('idx', domoDevice['domoticzIdx']), \
-                  ('nvalue', 0), ('svalue', str(reportedValue)+';0')])
-			# Don't loose the ";0" at the end - without it the database may corrupt. You don't want that.
-			r = domoticzAPI(payload)
-
-	# Checking if the 'Solar Radiation' device needs an update
-	elif domoDevice['categoryName'] == 'Solar Radiation' and domoDevice['domoticzSensorType'] == 20:
-		reportedValue = int(jsonQs['solarradiation'])
-		domoValue = int(r['result'][0]['Radiation'])
-		if reportedValue != domoValue or sensorTimedOut:
-			if isVerbose: print 'Updating the Domoticz Solar Radiation device to', reportedValue
-			if isVerbose and sensorTimedOut: print '<sensorTimedOut>'
-			payload = dict([('type', 'command'), ('param', 'udevice'), ('idx', domoDevice['domoticzIdx']), \
-                  ('nvalue', 0), ('svalue', reportedValue)])
-			r = domoticzAPI(payload)
-
-	# Checking if the 'Battery Alert' device needs an update
-	elif domoDevice['categoryName'] == 'Battery Alert' and domoDevice['domoticzSensorType'] == 7:
-		reportedValue = 0 if jsonQs['lowbatt'] == 0 else 4
-		rText = 'Everything seems fine' if jsonQs['lowbatt'] == 0 else 'Battery Alert!'
-		domoValue = r['result'][0]['Level']
-		if reportedValue != domoValue or sensorTimedOut:
-			if isVerbose: print 'Updating the Domoticz Battery Alert device to', reportedValue
-			if isVerbose and sensorTimedOut: print '<sensorTimedOut>'
-			payload = dict([('type', 'command'), ('param', 'udevice'), ('idx', domoDevice['domoticzIdx']), \
-                  ('nvalue', reportedValue), ('svalue', rText)])
-			r = domoticzAPI(payload)
+		return dataString
 
-	return
+	def changed(self, reported, device):
+		# No need to check the current value, it's likely to be different anyway
+		return True
+
+	def format(self, reported):
+		return 0, reported, dict(Data=reported)
+
+@domoUpdater('UV', 87)
+class UVUpdater(DomoUpdater):
+	minInterval = 60
+
+	def reported(self, jsonQs):
+		return jsonQs['UV'],
+
+	def current(self, device):
+		return int(float(device['UVI'])),
+
+	def format(self, reported):
+		# Don't loose the ";0" at the end - without it the database may corrupt. You don't want that.
+		return 0, str(reported[0])+';0', dict(UVI=str(reported[0]))
+
+@domoUpdater('Solar Radiation', 20)
+class SolarRadiationUpdater(DomoUpdater):
+	minInterval = 60
+
+	def reported(self, jsonQs):
+		return int(jsonQs['solarradiation']),
+
+	def current(self, device):
+		return int(device['Radiation']),
+
+	def format(self, reported):
+		return 0, reported[0], dict(Radiation=reported[0])
+
+@domoUpdater('Battery Alert', 7)
+class BatteryAlertUpdater(DomoUpdater):
+
+	def reported(self, jsonQs):
+		return 0 if jsonQs['lowbatt'] == 0 else 4,
+
+	def current(self, device):
+		return device['Level'],
+
+	def format(self, reported):
+		rText = 'Everything seems fine' if reported[0] == 0 else 'Battery Alert!'
+		return reported[0], rText, dict(Level=reported[0])
 
 def degToCompass(num):
 	val=int((num/22.5)+.5)
@@ -276,9 +1637,26 @@ def getHumStat(hum):
 	elif hum >=50 and hum <=60: return 1
 	else: return 0
 
-def getBaroForecast(mbar):
-	# Barometer forecast, 0 = Stable, 1 = Sunny, 2 = Cloudy, 3 = Unstable, 4 = Thunderstorm, 5 = Unknown, 6 = Cloudy/Rain
-	return 5
+# Barometer forecasts as Domoticz knows them
+BARO_STABLE = 0
+BARO_SUNNY = 1
+BARO_CLOUDY = 2
+BARO_UNSTABLE = 3
+BARO_THUNDERSTORM = 4
+BARO_UNKNOWN = 5
+BARO_CLOUDY_RAIN = 6
+
+def getBaroForecast(hPa, tendency):
+	# Forecast from the sea level pressure and its change over 3 hours, after the WMO tendency
+	# classes: within 1.6 hPa is steady, over 6 hPa is very rapid
+	if tendency is None: return BARO_UNKNOWN
+	if tendency <= -6.0: return BARO_THUNDERSTORM
+	if tendency <= -1.6: return BARO_CLOUDY_RAIN if hPa < 1005 else BARO_CLOUDY
+	if tendency >= 1.6: return BARO_SUNNY if hPa >= 1005 else BARO_UNSTABLE
+	if hPa >= 1020: return BARO_SUNNY
+	if hPa >= 1005: return BARO_STABLE
+	if hPa >= 990: return BARO_CLOUDY
+	return BARO_CLOUDY_RAIN
 
 def load_config():
 	try:
@@ -290,121 +1668,579 @@ def load_config():
 		sys.exit(0)
 	return cfg
 
-def connected_to_internet(url='http://www.google.com/', timeout=5):
+def connected_to_internet():
 	try:
-		_ = requests.head(url, timeout=timeout)
+		_ = internetUpstream.request('HEAD')
 		return True
-	except requests.ConnectionError:
+	except UpstreamError:
 		print('No internet connection available.')
 		return False
 
-def domoticzAPI(payload):
+#This class checks in the background whether the internet and the Domoticz servers can be reached,
+#so that reports are accepted from the moment the port is bound whatever the state of the network
+class HealthChecker(threading.Thread):
+
+	def __init__(self, interval, startupMessage):
+		threading.Thread.__init__(self, name='Health checker')
+		self.daemon = True
+		self.interval = interval
+		self.startupMessage = startupMessage
+		self.checks = {} # check name -> (ok, epoch of the check)
+		self.started = time.time()
+
+	def run(self):
+		while True:
+			for url, domo in domoticzServers.items():
+				# The bulk device request seeds the shadow cache, once it's seeded a version request will do
+				if domo.fetched is None:
+					ok = domo.refresh()
+				else:
+					ok = domo.api(dict([('type', 'command'), ('param', 'getversion')])) is not None
+				self.check('domoticz ' + url, ok)
+			if self.startupMessage:
+				logToDomoticz(MSG_EXEC, self.startupMessage)
+				self.startupMessage = None
+			self.check('internet', connected_to_internet())
+			time.sleep(self.interval)
+
+	def check(self, name, ok):
+		previous = self.checks.get(name)
+		self.checks[name] = (ok, time.time())
+		if previous is None:
+			metrics.gauge('wh2600_up', functools.partial(self.isUp, name), (('check', name),))
+		# Only changes are worth a log message, not every failing check
+		if ok and previous is not None and not previous[0]:
+			logToDomoticz(MSG_INFO, 'Connection restored: ' + name)
+		elif not ok and (previous is None or previous[0]) and name == 'internet':
+			logToDomoticz(MSG_ERROR, 'No internet connection available')
+
+	def isUp(self, name):
+		return 1 if self.checks[name][0] else 0
+
+	def status(self):
+		checks = dict((name, {'ok': ok, 'checked': datetime.utcfromtimestamp(checked).strftime('%Y-%m-%d %H:%M:%S')}) \
+				for name, (ok, checked) in self.checks.items())
+		if not checks:
+			state = 'starting'
+		elif all(check['ok'] for check in checks.values()):
+			state = 'ok'
+		else:
+			state = 'degraded'
+		return {'status': state, 'uptime': int(time.time() - self.started), 'checks': checks}
+
+def startHealthChecks(startupMessage):
+	global healthChecker
+	healthChecker = HealthChecker(cfg['system'].get('healthCheckInterval', HEALTH_CHECK_INTERV), startupMessage)
+	healthChecker.start()
+
+#This class captures cProfile statistics of the report handler for a while and dumps them to system.tmpFolder,
+#as a .prof file for pstats and a text summary. Every request runs on a thread of its own, so each request is
+#profiled on its own and the statistics are added up
+class Profiler(object):
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.stats = None
+		self.requests = 0
+		self.until = 0 # Epoch the running capture ends, 0 when there is none
+
+	def start(self, seconds):
+		with self.lock:
+			if self.until: return False
+			self.stats = None
+			self.requests = 0
+			self.until = time.time() + seconds
+		timer = threading.Timer(seconds, self.stop)
+		timer.daemon = True
+		timer.start()
+		return True
+
+	def run(self, func):
+		if not self.until: return func()
+		profile = cProfile.Profile()
+		try:
+			return profile.runcall(func)
+		finally:
+			with self.lock:
+				if self.until:
+					if self.stats is None:
+						self.stats = pstats.Stats(profile)
+					else:
+						self.stats.add(profile)
+					self.requests += 1
+
+	def stop(self):
+		with self.lock:
+			stats, requests = self.stats, self.requests
+			self.stats = None
+			self.until = 0
+		if stats is None:
+			print 'Profile capture ended without any request'
+			return None
+		path = os.path.join(cfg['system']['tmpFolder'], time.strftime('interceptWH2600-%Y%m%d-%H%M%S.prof'))
+		# A diagnostic must never take the daemon down, whatever the state of tmpFolder
+		try:
+			stats.dump_stats(path)
+			summary = StringIO()
+			summary.write('Profile of ' + str(requests) + ' requests\n')
+			pstats.Stats(path, stream=summary).sort_stats('cumulative').print_stats(PROFILE_TOP)
+			with open(path[:-len('.prof')] + '.txt', 'w') as f:
+				f.write(summary.getvalue())
+		except Exception:
+			print 'Failed to write the profile', path, ':', sys.exc_info()[1]
+			return None
+		print 'Profile of', requests, 'requests written to', path
+		return path
+
+#This class reports how the resident memory and the number of live objects of each type grow between
+#snapshots. Python 2 has no tracemalloc, so the objects the garbage collector tracks are counted by type
+class MemoryTracker(object):
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.previous = None # (epoch, RSS in kB, Counter of objects by type)
+
+	def report(self):
+		gc.collect()
+		counts = collections.Counter(type(o).__name__ for o in gc.get_objects())
+		rss = memoryUsage()
+		with self.lock:
+			previous, self.previous = self.previous, (time.time(), rss, counts)
+		total = sum(counts.values())
+		lines = ['Resident memory ' + str(rss) + ' kB, ' + str(total) + ' objects']
+		if previous is None:
+			lines.append('First snapshot, the most common object types:')
+			lines += ['%10d  %s' % (n, name) for name, n in counts.most_common(MEMORY_TOP)]
+		else:
+			lines[0] += ', %+d kB and %+d objects since %s' % (rss - previous[1], total - sum(previous[2].values()), \
+					time.ctime(previous[0]))
+			growth = counts.copy()
+			growth.subtract(previous[2])
+			lines.append('Object types that grew the most, count and growth:')
+			lines += ['%10d %+8d  %s' % (counts[name], n, name) for name, n in growth.most_common(MEMORY_TOP) if n > 0]
+		return '\n'.join(lines) + '\n'
+
+def memoryUsage():
+	# Resident set size in kB, from /proc where available
 	try:
-		r = requests.get(cfg['domoticz']['protocol'] + '://' + cfg['domoticz']['hostName'] + ':' + \
-				str(cfg['domoticz']['portNumber']) + '/json.htm', \
-				verify=False, \
-				auth=(cfg['domoticz']['httpBasicAuth']['userName'], cfg['domoticz']['httpBasicAuth']['passWord']), \
-				params=payload)
-	except:
-		print('Can not open domoticz URL: \'' + cfg['domoticz']['protocol'] + '://' + cfg['domoticz']['hostName'] + ':' + \
-					str(cfg['domoticz']['portNumber']) + '/json.htm\'', sys.exc_info()[0])
-		sys.exit(0)
-	if r.status_code <> 200:
-		print 'Unexpected status code from Domoticz: ' + str(r.status_code)
-		sys.exit(0)
+		with open('/proc/self/statm') as f:
+			return int(f.read().split()[1]) * resource.getpagesize() / 1024
+	except IOError:
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+profiler = Profiler()
+memoryTracker = MemoryTracker()
+
+def getVerbosity():
+	return 'debug' if isDebug else 'verbose' if isVerbose else 'quiet'
+
+def setVerbosity(level):
+	global isVerbose, isDebug
+	isVerbose = level in ('verbose', 'debug')
+	isDebug = level == 'debug'
+
+def startProfile(signum=None, frame=None):
+	# SIGUSR1 handler
+	if not profiler.start(cfg['system'].get('profileSeconds', PROFILE_SECONDS)):
+		print 'A profile capture is running already'
+
+def reportMemory(signum=None, frame=None):
+	# SIGUSR2 handler, the report is also appended to a file as the daemon's output may go nowhere
+	report = time.ctime() + '\n' + memoryTracker.report()
+	print report
+	path = os.path.join(cfg['system']['tmpFolder'], 'interceptWH2600-memory.txt')
+	# Runs on the main thread in the middle of serve_forever, an exception here would stop the daemon
 	try:
-		rJsonDecoded = r.json()
-	except:
-		print('Can\'t Json decode response from Domoticz.', sys.exc_info()[0])
-		sys.exit(0)
-	if rJsonDecoded['status'] <> 'OK':
-		print 'Unexpected response from Domoticz: ' + rJsonDecoded['status']
-		sys.exit(0)
-	return rJsonDecoded
+		with open(path, 'a') as f:
+			f.write(report + '\n')
+	except Exception:
+		print 'Failed to write the memory report to', path, ':', sys.exc_info()[1]
+
+#This class talks to one Domoticz server and keeps a shadow cache of its devices, keyed by idx
+class Domoticz(object):
+
+	def __init__(self, domoCfg):
+		self.cfg = domoCfg
+		self.upstream = Upstream('Domoticz', domoticzURL(domoCfg), \
+				auth=(domoCfg['httpBasicAuth']['userName'], domoCfg['httpBasicAuth']['passWord']), \
+				verify=False)
+		self.devices = {}
+		self.missing = set() # idx of the devices Domoticz didn't know since the latest bulk request
+		self.fetched = None
+		self.cacheLock = threading.Lock()
+		self.refreshLock = threading.Lock() # One bulk request at a time, however many stations miss the cache
+		self.lastRefresh = 0 # When the latest bulk request ended, whether it worked or not
+		self.pool = ThreadPool(domoCfg.get('writeWorkers', DOMO_WRITE_WORKERS))
+
+	def api(self, payload):
+		# Returns the decoded response or None when Domoticz can't be reached or doesn't answer OK
+		try:
+			r = self.upstream.get(payload)
+		except UpstreamError as e:
+			print('Can not open domoticz URL: \'' + self.upstream.url + '\'', e)
+			return None
+		if r.status_code <> 200:
+			print 'Unexpected status code from Domoticz: ' + str(r.status_code)
+			return None
+		try:
+			rJsonDecoded = r.json()
+		except:
+			print('Can\'t Json decode response from Domoticz.', sys.exc_info()[0])
+			return None
+		if rJsonDecoded['status'] <> 'OK':
+			print 'Unexpected response from Domoticz: ' + rJsonDecoded['status']
+			return None
+		return rJsonDecoded
+
+	def log(self, messageType, logMessage):
+		payload = dict([('type', 'command'), ('param', 'addlogmessage'), \
+							('message', '(' + messageType+ ') ' + os.path.basename(sys.argv[0]) + ': ' + logMessage)])
+		return self.api(payload)
+
+	def sendUpdate(self, idx, nvalue, svalue, **shadow):
+		# Push a new device value to Domoticz and record what was pushed in the shadow cache
+		payload = dict([('type', 'command'), ('param', 'udevice'), ('idx', idx), \
+				('nvalue', nvalue), ('svalue', svalue)])
+		r = self.api(payload)
+		if r is None:
+			# Unknown what Domoticz ended up with, so don't trust the cache
+			self.invalidate()
+			return r
+		with self.cacheLock:
+			device = self.devices.setdefault(str(idx), {})
+			device.update(shadow)
+			device['LastUpdate'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+		return r
+
+	def sendUpdates(self, writes):
+		# Domoticz takes one device per request, so the updates due at the same time go out in parallel
+		self.pool.map(self.push, writes)
+
+	def push(self, write):
+		updater, nvalue, svalue, shadow = write
+		if self.sendUpdate(updater.idx, nvalue, svalue, **shadow) is not None:
+			updater.lastPush = time.time()
+
+	def refresh(self, unlessSince=None):
+		# One bulk request seeds the shadow cache with every device Domoticz knows about. Stations that
+		# waited for another one's request pass when they started waiting and don't ask again
+		with self.refreshLock:
+			if unlessSince is not None and self.lastRefresh >= unlessSince: return self.fetched is not None
+			try:
+				payload = dict([('type', 'devices'), ('filter', 'all'), ('used', 'true')])
+				r = self.api(payload)
+				if r is None or not 'result' in r.keys():
+					print 'Failure getting the device list from Domoticz'
+					return False
+				with self.cacheLock:
+					self.devices = dict((str(d['idx']), d) for d in r['result'])
+					self.missing = set()
+					self.fetched = time.time()
+				if isVerbose: print 'Domoticz device cache refreshed,', len(self.devices), 'devices'
+				return True
+			finally:
+				self.lastRefresh = time.time()
+
+	def invalidate(self):
+		# Forces a bulk refresh of the shadow cache before it's used the next time
+		self.fetched = None
+
+	def getDevice(self, idx):
+		ttl = self.cfg.get('deviceCacheTTL', DOMO_CACHE_TTL)
+		if self.fetched is None or (time.time() - self.fetched) >= ttl:
+			self.refresh(time.time())
+		device = self.devices.get(str(idx))
+		if device is None and self.fetched is not None and str(idx) not in self.missing:
+			device = self.fetchDevice(idx)
+		return device
+
+	def fetchDevice(self, idx):
+		# A device the bulk request didn't bring is asked for on its own, once until the next bulk request
+		r = self.api(dict([('type', 'devices'), ('rid', idx)]))
+		with self.cacheLock:
+			if r is not None and r.get('result'):
+				device = self.devices[str(idx)] = r['result'][0]
+				return device
+			self.missing.add(str(idx))
+		return None
+
+def domoticzURL(domoCfg):
+	return domoCfg['protocol'] + '://' + domoCfg['hostName'] + ':' + str(domoCfg['portNumber']) + '/json.htm'
+
+def getDomoticz(domoCfg):
+	# Stations sharing a Domoticz server share its connection pool and device cache, not their devices
+	url = domoticzURL(domoCfg)
+	with stationsLock:
+		if url not in domoticzServers:
+			domoticzServers[url] = Domoticz(domoCfg)
+		return domoticzServers[url]
+
+def domoticzAPI(payload):
+	return defaultDomoticz.api(payload)
 
 def logToDomoticz(messageType, logMessage):
-	payload = dict([('type', 'command'), ('param', 'addlogmessage'), \
-						('message', '(' + messageType+ ') ' + os.path.basename(sys.argv[0]) + ': ' + logMessage)])
-	r = domoticzAPI(payload)
-	return r
+	return defaultDomoticz.log(messageType, logMessage)
 
-def saveWindData(jsonQs):
-	global arrWindDir, arrWindSpeed, arrGustSpeed
-	global average_wind_speed_2min, max_gust_speed_2min, wdir_2min
-	global average_wind_speed_10min, max_gust_speed_10min, wdir_10min
+#This class keeps the statistics of the latest `size` wind samples (m/s with one decimal) in a ring buffer.
+#Running sums and a monotonic deque of gusts make every new sample cost the same whatever the window length
+class RollingWindow(object):
+
+	def __init__(self, size):
+		self.size = size
+		self.speed = [0.0] * size
+		self.direction = [0] * size
+		self.gust = [0.0] * size
+		self.east = [0.0] * size
+		self.north = [0.0] * size
+		self.pos = 0 # Ring buffer slot that the next sample will overwrite
+		self.count = 0 # Number of samples pushed so far
+		self.speedSum = 0 # In tenths of m/s, as integer it can't drift
+		self.eastSum = 0.0
+		self.northSum = 0.0
+		self.gusts = collections.deque() # (sample number, gust) pairs with decreasing gusts
+
+	def push(self, speed, direction, gust):
+		rad = direction * math.pi / 180.0
+		east = speed * math.sin(rad)
+		north = speed * math.cos(rad)
+		i = self.pos
+		self.speedSum += int(round(speed * 10)) - int(round(self.speed[i] * 10))
+		self.eastSum += east - self.east[i]
+		self.northSum += north - self.north[i]
+		self.speed[i] = speed
+		self.direction[i] = direction
+		self.gust[i] = gust
+		self.east[i] = east
+		self.north[i] = north
+		self.pos = (i + 1) % self.size
+		if self.pos == 0:
+			# Once per lap, get rid of the rounding errors accumulated in the running sums
+			self.eastSum = math.fsum(self.east)
+			self.northSum = math.fsum(self.north)
+		# A gust is of no use once a later gust at least as strong has arrived
+		while self.gusts and self.gusts[-1][1] <= gust:
+			self.gusts.pop()
+		self.gusts.append((self.count, gust))
+		if self.gusts[0][0] <= self.count - self.size:
+			self.gusts.popleft()
+		self.count += 1
+
+	def meanSpeed(self):
+		# The average wind speed is a simple average of wind velocity, regardless of direction
+		return self.speedSum / 10.0 / self.size
+
+	def maxGust(self):
+		return self.gusts[0][1]
+
+	def resultant(self):
+		return resultant(self.eastSum, self.northSum, self.size)
+
+	def ordered(self, values):
+		# Values of the window, oldest first
+		return values[self.pos:] + values[:self.pos]
+
+	def restore(self, samples):
+		# Refills an empty window with saved (speed, direction, gust) samples, oldest first. A window
+		# that has grown since it was saved is primed with the oldest sample, as WindStats does
+		samples = list(samples[-self.size:])
+		for speed, direction, gust in [samples[0]] * (self.size - len(samples)) + samples:
+			self.push(speed, direction, gust)
+
+#This class feeds each wind sample to all configured windows
+class WindStats(object):
+
+	def __init__(self, windows):
+		self.windows = dict((name, RollingWindow(size)) for name, size in windows.items())
+
+	def __getitem__(self, name):
+		return self.windows[name]
+
+	def push(self, speed, direction, gust):
+		for w in self.windows.itervalues():
+			if w.count == 0:
+				# Until there is history, the first reading stands for the whole window
+				for i in range(w.size - 1):
+					w.push(speed, direction, gust)
+			w.push(speed, direction, gust)
+
+def windWindows():
+	# Window lengths in number of samples. 4last, 2min and 10min are always there,
+	# more can be added in config.json as {"name": seconds}, e.g. {"60min": 3600}
+	windows = {'4last': 4, '2min': 2*60/UPDATE_INTERV, '10min': 10*60/UPDATE_INTERV}
+	for name, seconds in cfg['system'].get('windWindows', {}).items():
+		windows[name] = max(1, int(seconds) / UPDATE_INTERV)
+	return windows
+
+def saveWindData(station, jsonQs):
+	windStats = station.windStats
+	if not ('windspeedmph' in jsonQs and 'windgustmph' in jsonQs and 'winddir' in jsonQs):
+		if isVerbose: print 'No wind in the reading'
+		return
 
 	# Conversion base : 1 mph = 0.44704 mps
 	windSpeed = round(jsonQs['windspeedmph'] * 0.44704, 1)
 	windGustSpeed = round(jsonQs['windgustmph'] * 0.44704, 1)
 	windDir = jsonQs['winddir']
-	if runs == 1:
-		# Array will hold approximately 10 minutes of data
-		elements = 10*60/UPDATE_INTERV
-		arrWindDir = [windDir] * elements
-		arrWindSpeed = [windSpeed] * elements
-		arrGustSpeed = [windGustSpeed] * elements
-		wdir_4last = wdir_2min = wdir_10min = windDir
-		average_wind_speed_2min = average_wind_speed_10min = windSpeed
-		max_gust_speed_2min = max_gust_speed_10min = windGustSpeed
-	else:
-		# Delete the oldest reading
-		arrWindDir.pop(0)
-		arrWindSpeed.pop(0)
-		arrGustSpeed.pop(0)
-		# Push the latest reading onto the end of array
-		arrWindDir.append(windDir)
-		arrWindSpeed.append(windSpeed)
-		arrGustSpeed.append(windGustSpeed)
-	
-		elements2min = 2*60/UPDATE_INTERV
-		# The average wind speed is a simple average of wind velocity, regardless of direction
-		average_wind_speed_2min = round(sum(arrWindSpeed[-elements2min:]) / elements2min, 1)
-		average_wind_speed_10min = round(sum(arrWindSpeed) / len(arrWindSpeed), 1)
-		max_gust_speed_2min = max(arrGustSpeed[-elements2min:])
-		max_gust_speed_10min = max(arrGustSpeed)
-
-		if cfg['system']['windDirSmoothenizer']: wspd_4last, wdir_4last = windvec(scipy.array(arrWindSpeed[-4:]), scipy.array(arrWindDir[-4:]))
-		wspd_2min, wdir_2min = windvec(scipy.array(arrWindSpeed[-elements2min:]), scipy.array(arrWindDir[-elements2min:]))
-		wspd_10min, wdir_10min = windvec(scipy.array(arrWindSpeed), scipy.array(arrWindDir))
-
-		if isVerbose:
-			print 'Past 2 minutes resultant wind direction:', wdir_2min
-			print 'Past 10 minutes resultant wind direction:',  wdir_10min
-			print 'Past 2 minutes average wind speed:',  average_wind_speed_2min
-			print 'Past 10 minutes average wind speed:',  average_wind_speed_10min
-			print 'Past 2 minutes maximum wind gust speed:',  max_gust_speed_2min
-			print 'Past 10 minutes maximum wind gust speed:',  max_gust_speed_10min
-		if isDebug and isVerbose:
-			print arrWindDir
-			print arrWindSpeed
-			print arrGustSpeed
+	windStats.push(windSpeed, windDir, windGustSpeed)
+
+	w2min = windStats['2min']
+	w10min = windStats['10min']
+	average_wind_speed_2min = round(w2min.meanSpeed(), 1)
+	average_wind_speed_10min = round(w10min.meanSpeed(), 1)
+	max_gust_speed_2min = w2min.maxGust()
+	max_gust_speed_10min = w10min.maxGust()
+	wspd_4last, wdir_4last = windStats['4last'].resultant()
+	wspd_2min, wdir_2min = w2min.resultant()
+	wspd_10min, wdir_10min = w10min.resultant()
+
+	if isVerbose:
+		print 'Past 2 minutes resultant wind direction:', wdir_2min
+		print 'Past 10 minutes resultant wind direction:',  wdir_10min
+		print 'Past 2 minutes average wind speed:',  average_wind_speed_2min
+		print 'Past 10 minutes average wind speed:',  average_wind_speed_10min
+		print 'Past 2 minutes maximum wind gust speed:',  max_gust_speed_2min
+		print 'Past 10 minutes maximum wind gust speed:',  max_gust_speed_10min
+	if isDebug and isVerbose:
+		print w10min.ordered(w10min.direction)
+		print w10min.ordered(w10min.speed)
+		print w10min.ordered(w10min.gust)
 
 	if isDebug: print '\nLatest wind speed reading: ', jsonQs['winddir']
 	if cfg['system']['windDirSmoothenizer']:
 		jsonQs['winddir'] = wdir_4last
 		if isDebug: print '\'windDirSmoothenizer\' is active. Resultant of the last 4 wind direction readings (Reported to WU) : ', wdir_4last
-		if isDebug: print 'array', arrWindDir[-4:], "\n"
+		if isDebug: print 'array', windStats['4last'].ordered(windStats['4last'].direction), "\n"
 	jsonQs['windspdmph_avg2m'] = round(mph(average_wind_speed_2min), 2)
 	jsonQs['windspdmph_avg10m'] = round(mph(average_wind_speed_10min), 2)
 	jsonQs['windgustmph_2m'] = round(mph(max_gust_speed_2min), 2)
 	jsonQs['windgustmph_10m'] = round(mph(max_gust_speed_10min), 2)
 	jsonQs['winddir_avg2m'] = wdir_2min
 	jsonQs['winddir_avg10m'] = wdir_10min
+	# Windows added in config.json are reported the same way, e.g. windspdmph_avg60min
+	for name, w in windStats.windows.items():
+		if name in ('4last', '2min', '10min'): continue
+		jsonQs['windspdmph_avg' + name] = round(mph(round(w.meanSpeed(), 1)), 2)
+		jsonQs['windgustmph_' + name] = round(mph(w.maxGust()), 2)
+		jsonQs['winddir_avg' + name] = w.resultant()[1]
 	return
 
-# See http://python.hydrology-amsterdam.nl/modules/meteolib.py
-def windvec(u= scipy.array([]), D=scipy.array([])):
-	ve = 0.0 # define east component of wind speed
-	vn = 0.0 # define north component of wind speed
-	D = D * math.pi / 180.0 # convert wind direction degrees to radians
-	for i in range(0, len(u)):
-		ve = ve + u[i] * math.sin(D[i]) # calculate sum east speed components
-		vn = vn + u[i] * math.cos(D[i]) # calculate sum north speed components
-	ve = - ve / len(u) # determine average east speed component
-	vn = - vn / len(u) # determine average north speed component
+#This class holds one tumbling window of readings: the minimum, maximum, sum and latest value of every field,
+#the wind vector sums and the rain that fell. Every reading costs the same whatever the window length
+class RollupBucket(object):
+
+	def __init__(self, start):
+		self.start = start # UTC epoch seconds
+		self.count = 0
+		self.stats = {} # field -> [minimum, maximum, sum, latest, number of values]
+		self.windEast = 0.0
+		self.windNorth = 0.0
+		self.windCount = 0
+		self.rain = 0.0
+		self.partial = False # Whether readings of the window were missed, by a restart or before the first one
+
+	def state(self):
+		# A copy of the bucket for the checkpoint, (start, count, partial, windEast, windNorth, windCount, rain, stats)
+		return (self.start, self.count, self.partial, self.windEast, self.windNorth, self.windCount, self.rain, \
+				dict((field, list(stats)) for field, stats in self.stats.iteritems()))
+
+	def restore(self, state):
+		# Refills a new bucket from its checkpointed state
+		self.start, self.count, self.partial, self.windEast, self.windNorth, self.windCount, self.rain, self.stats = state
+		return self
+
+	def add(self, reading, rain):
+		self.count += 1
+		for field, value in reading.iteritems():
+			# The mean of a direction is the vector mean below, the other statistics make no sense for it
+			if field == 'winddir': continue
+			stats = self.stats.get(field)
+			if stats is None:
+				self.stats[field] = [value, value, value, value, 1]
+				continue
+			if value < stats[0]:
+				stats[0] = value
+			elif value > stats[1]:
+				stats[1] = value
+			stats[2] += value
+			stats[3] = value
+			stats[4] += 1
+		if 'windspeedmph' in reading and 'winddir' in reading:
+			rad = reading['winddir'] * math.pi / 180.0
+			self.windEast += reading['windspeedmph'] * math.sin(rad)
+			self.windNorth += reading['windspeedmph'] * math.cos(rad)
+			self.windCount += 1
+		self.rain += rain
+
+	def summary(self, resolution):
+		# e.g. tempf_min, tempf_max, tempf_mean and tempf_last for tempf, plus the vector mean wind and rainfallin
+		payload = {'resolution': resolution, 'count': self.count, 'rainfallin': round(self.rain, 3), \
+				'partial': 1 if self.partial else 0}
+		for field, (minimum, maximum, total, latest, n) in self.stats.iteritems():
+			payload[field + '_min'] = minimum
+			payload[field + '_max'] = maximum
+			payload[field + '_mean'] = round(float(total) / n, 4)
+			payload[field + '_last'] = latest
+		if self.windCount:
+			payload['windspeedmph_vector'], payload['winddir_vector'] = resultant(self.windEast, self.windNorth, self.windCount)
+		return payload
+
+#This class rolls the readings of a station up into tumbling windows of several lengths.
+#A bucket is closed by the first reading after its end. The open buckets are checkpointed with
+#the wind windows, a bucket that missed readings all the same is marked partial
+class Rollups(object):
+
+	def __init__(self, resolutions):
+		self.resolutions = sorted(resolutions.items(), key=lambda resolution: resolution[1])
+		self.buckets = {} # resolution name -> RollupBucket
+		self.resumed = None # Latest reading epoch before a restart, until the first reading after it
+
+	def push(self, timestamp, reading, rain):
+		# Returns the (resolution name, bucket) pairs the reading closed. The rain since the previous
+		# reading is the one Meteo worked out
+		closed = []
+		timestamp = int(timestamp)
+		gap = self.resumed is not None and timestamp - self.resumed > ROLLUP_MAX_GAP
+		self.resumed = None
+		if gap:
+			for bucket in self.buckets.itervalues():
+				bucket.partial = True
+		for name, seconds in self.resolutions:
+			start = timestamp - timestamp % seconds
+			bucket = self.buckets.get(name)
+			if bucket is None or bucket.start != start:
+				if bucket is not None: closed.append((name, bucket))
+				missed = bucket is None or gap
+				bucket = self.buckets[name] = RollupBucket(start)
+				# Started late, the beginning of the window went by while nobody was listening
+				bucket.partial = missed and timestamp - start >= UPDATE_INTERV
+			bucket.add(reading, rain)
+		return closed
+
+	def restore(self, lastReading, buckets):
+		# Carries on with the checkpointed buckets of the resolutions still wanted
+		self.resumed = lastReading
+		for name, seconds in self.resolutions:
+			if name in buckets: self.buckets[name] = buckets[name]
+
+def rollupResolutions(wantedOnly=True):
+	# Lengths in seconds of the rollups that some sink wants, or of all of them. 1min, 5min, hourly and daily
+	# are always there, more can be added in config.json as {"name": seconds}, e.g. {"15min": 900}
+	resolutions = dict(ROLLUP_RESOLUTIONS)
+	for name, seconds in cfg['system'].get('rollupResolutions', {}).items():
+		resolutions[name] = max(1, int(seconds))
+	if not wantedOnly: return resolutions
+	wanted = set()
+	for sink in sinks:
+		wanted.update(sink.rollups)
+	return dict((name, seconds) for name, seconds in resolutions.items() if name in wanted)
+
+def resultant(eastSum, northSum, n):
+	# Resultant wind speed and direction from the sums of n east and north speed components
+	ve = - eastSum / n # determine average east speed component
+	vn = - northSum / n # determine average north speed component
 	uv = math.sqrt(ve * ve + vn * vn) # calculate wind speed vector magnitude
 	# Calculate wind speed vector direction
-	vdir = scipy.arctan2(ve, vn)
+	vdir = math.atan2(ve, vn)
 	vdir = vdir * 180.0 / math.pi # Convert radians to degrees
 	if vdir < 180:
 		Dv = vdir + 180.0
@@ -415,12 +2251,53 @@ def windvec(u= scipy.array([]), D=scipy.array([])):
 			Dv = vdir
 	return round(uv, 1), int(round(Dv)) # uv in m/s, Dv in dgerees from North
 
+# See http://python.hydrology-amsterdam.nl/modules/meteolib.py
+def windvec(u=(), D=()):
+	import numpy
+	u = numpy.asarray(u, dtype=float)
+	D = numpy.asarray(D, dtype=float) * math.pi / 180.0 # convert wind direction degrees to radians
+	# cumsum adds up in the same order as a plain loop would, so results are identical to the loop
+	ve = numpy.cumsum(u * numpy.sin(D))[-1] # calculate sum east speed components
+	vn = numpy.cumsum(u * numpy.cos(D))[-1] # calculate sum north speed components
+	return resultant(float(ve), float(vn), len(u))
+
+def windvec_batch(u, D, windows):
+	"""Resultant wind speed and direction of many windows in one go.
+	windows is either a window length, giving every window of that many consecutive samples
+	(the first one ending at sample windows-1), or a sequence of (start, stop) slices, e.g. [(0, len(u))] for
+	the whole day. Returns two arrays, speeds in m/s with one decimal and directions in whole degrees from North"""
+	import numpy
+	u = numpy.asarray(u, dtype=float)
+	D = numpy.asarray(D, dtype=float) * math.pi / 180.0
+	if isinstance(windows, (int, long)):
+		start = numpy.arange(0, max(len(u) - windows + 1, 0))
+		stop = start + windows
+	else:
+		bounds = numpy.asarray(windows, dtype=int).reshape(-1, 2)
+		start, stop = bounds[:, 0], bounds[:, 1]
+	# The sum of any window is the difference of two cumulative sums
+	east = numpy.concatenate(([0.0], numpy.cumsum(u * numpy.sin(D))))
+	north = numpy.concatenate(([0.0], numpy.cumsum(u * numpy.cos(D))))
+	n = (stop - start).astype(float)
+	ve = - (east[stop] - east[start]) / n
+	vn = - (north[stop] - north[start]) / n
+	uv = numpy.floor(numpy.sqrt(ve * ve + vn * vn) * 10 + 0.5) / 10
+	vdir = numpy.arctan2(ve, vn) * 180.0 / math.pi
+	Dv = numpy.where(vdir < 180, vdir + 180.0, vdir - 180)
+	return uv, numpy.floor(Dv + 0.5).astype(int)
+
 def print_help(argv):
 	print 'usage: ' + os.path.basename(__file__) + ' [option]  [-C domoticzDeviceidx|all] \nOptions and arguments'
 	print '-d     : debug output (also --debug)'
 	print '-h     : print this help message and exit (also --help)'
+	print '-q ID  : print the archived readings of station ID as CSV and exit (also --query=ID)'
+	print '         --from=DATE, --to=DATE : time range in UTC, YYYY-MM-DD[ HH:MM[:SS]], default today'
+	print '         --fields=F1,F2 : fields to print, default all'
 	print '-v     : verbose'
 	print '-V     : print the version number and exit (also --version)'
+	print 'While running : kill -USR1 profiles the report handler for system.profileSeconds and kill -USR2 reports'
+	print '         memory growth, both to system.tmpFolder. From the local host the same is available on'
+	print '         /debug/profile?seconds=N, /debug/memory and /debug/verbosity?level=quiet|verbose|debug'
 
 def temp_f(c):
 	"Convert temperature from Celsius to Fahrenheit"
@@ -459,22 +2336,130 @@ def wind_chill(temp, wind):
 	if wind_kph <= 4.8 or temp > 10.0: return temp
 	return min(13.12 + (temp * 0.6215) + (((0.3965 * temp) - 11.37) * (wind_kph ** 0.16)), temp)
 
-def is_number(s):
-	try:
-		n=str(float(s))
-		if n == "nan" or n=="inf" or n=="-inf" : return False
-	except ValueError:
-		try:
-			complex(s) # for complex
-		except ValueError:
-			return False
-	return True
+def dew_point(temp, humidity):
+	# Magnus formula with the Sonntag constants, temp in Celsius
+	if temp is None or not humidity: return None
+	gamma = math.log(humidity / 100.0) + 17.62 * temp / (243.12 + temp)
+	return 243.12 * gamma / (17.62 - gamma)
+
+def heat_index(temp, humidity):
+	# NWS heat index, see https://www.wpc.ncep.noaa.gov/html/heatindex_equation.shtml, temp in Fahrenheit
+	if temp is None or humidity is None: return None
+	hi = 0.5 * (temp + 61.0 + (temp - 68.0) * 1.2 + humidity * 0.094)
+	if (hi + temp) / 2 < 80: return hi
+	hi = -42.379 + 2.04901523 * temp + 10.14333127 * humidity - 0.22475541 * temp * humidity \
+			- 0.00683783 * temp * temp - 0.05481717 * humidity * humidity + 0.00122874 * temp * temp * humidity \
+			+ 0.00085282 * temp * humidity * humidity - 0.00000199 * temp * temp * humidity * humidity
+	if humidity < 13 and 80 <= temp <= 112:
+		hi -= (13 - humidity) / 4.0 * math.sqrt((17 - abs(temp - 95)) / 17.0)
+	elif humidity > 85 and 80 <= temp <= 87:
+		hi += (humidity - 85) / 10.0 * (87 - temp) / 5.0
+	return hi
+
+# Conversions done once for every reading: field, converted field and converter
+CONVERSIONS = (
+	('tempf', 'tempc', temp_c),
+	('indoortempf', 'indoortempc', temp_c),
+	('dewptf', 'dewptc', temp_c),
+	('baromin', 'baromhpa', mbar),
+	('windspeedmph', 'windspeedms', ms),
+	('windgustmph', 'windgustms', ms),
+	('windspdmph_avg2m', 'windspdms_avg2m', ms),
+	('windspdmph_avg10m', 'windspdms_avg10m', ms),
+	('windgustmph_2m', 'windgustms_2m', ms),
+	('windgustmph_10m', 'windgustms_10m', ms),
+	('rainin', 'rainmm', mm),
+	('dailyrainin', 'dailyrainmm', mm),
+	('yearlyrainin', 'yearlyrainmm', mm),
+)
+
+#This class derives the converted and computed quantities of the readings of a station, each once per reading,
+#so that every destination reads the same values. It keeps the pressure and rain history the tendency and rate need,
+#which is checkpointed with the wind windows
+class Meteo(object):
+
+	def __init__(self):
+		self.pressures = collections.deque() # (epoch, hPa), one every BARO_SAMPLE_INTERV seconds
+		self.rain = collections.deque() # (epoch, hundredths of inches of rain since the previous reading)
+		self.rainSum = 0 # In hundredths of inches, the resolution of the station, as integer it can't drift
+		self.lastDailyRain = None
+
+	def derive(self, timestamp, reading):
+		# Adds the derived fields to the reading, leaving out the ones whose inputs are missing
+		for field, converted, convert in CONVERSIONS:
+			if field in reading: reading[converted] = convert(reading[field])
+		tempc = reading.get('tempc')
+		humidity = reading.get('humidity')
+		if 'dewptc' not in reading and tempc is not None and humidity:
+			reading['dewptc'] = dew_point(tempc, humidity)
+		if 'tempf' in reading and humidity is not None:
+			reading['heatindexf'] = heat_index(reading['tempf'], humidity)
+			reading['heatindexc'] = temp_c(reading['heatindexf'])
+		if tempc is not None and 'windspdms_avg10m' in reading:
+			reading['windchillc'] = wind_chill(tempc, reading['windspdms_avg10m'])
+		if 'baromhpa' in reading:
+			tendency = self.pressureTendency(timestamp, reading['baromhpa'])
+			if tendency is not None: reading['barotrendhpa'] = tendency
+			reading['baroforecast'] = getBaroForecast(reading['baromhpa'], tendency)
+		fell = self.rainfall(reading['dailyrainin']) if 'dailyrainin' in reading else None
+		if fell is not None:
+			reading['rainfallin'] = fell / 100.0
+			reading['rainratemm'] = mm(self.rainRate(timestamp, fell))
+		elif 'rainmm' in reading:
+			# Without the accumulator, the rain of the past hour is the best rate there is
+			reading['rainratemm'] = reading['rainmm']
+
+	def pressureTendency(self, timestamp, hPa):
+		# Change of pressure over BARO_TENDENCY_WINDOW, extrapolated while the history is shorter
+		pressures = self.pressures
+		if not pressures or timestamp - pressures[-1][0] >= BARO_SAMPLE_INTERV:
+			pressures.append((timestamp, hPa))
+		while timestamp - pressures[0][0] > BARO_TENDENCY_WINDOW:
+			pressures.popleft()
+		span = timestamp - pressures[0][0]
+		if span < BARO_MIN_HISTORY: return None
+		return (hPa - pressures[0][1]) * BARO_TENDENCY_WINDOW / span
+
+	def rainfall(self, daily):
+		# Hundredths of inches of rain since the previous reading, from the daily accumulator that starts again at midnight.
+		# The rain rate and the rollups both take it from here. None when the accumulator can't be right, like the
+		# -9999 of a station without rain gauge, which then leaves the latest daily rain as it is
+		if daily < 0: return None
+		last = self.lastDailyRain
+		fell = 0 if last is None else int(round((daily - last if daily >= last else daily) * 100))
+		if fell > RAIN_MAX_FALL:
+			if isVerbose: print 'Ignoring a daily rain of', daily, 'after', last
+			return None
+		self.lastDailyRain = daily
+		return fell
+
+	def rainRate(self, timestamp, fell):
+		# Inches per hour over RAIN_RATE_WINDOW
+		self.rain.append((timestamp, fell))
+		self.rainSum += fell
+		while timestamp - self.rain[0][0] > RAIN_RATE_WINDOW:
+			self.rainSum -= self.rain.popleft()[1]
+		return self.rainSum / 100.0 * 3600.0 / RAIN_RATE_WINDOW
+
+	def state(self):
+		# A copy of the history for the checkpoint, (latest daily rain, [(epoch, hPa)], [(epoch, hundredths of inches)])
+		return self.lastDailyRain, list(self.pressures), list(self.rain)
+
+	def restore(self, state):
+		lastDailyRain, pressures, rain = state
+		self.lastDailyRain = lastDailyRain
+		self.pressures = collections.deque(pressures)
+		self.rain = collections.deque(rain)
+		self.rainSum = sum(fell for epoch, fell in rain)
 
 def main(argv):
 	global isDebug
 	global isVerbose
+	queryStation = None
+	queryFrom = queryTo = None
+	queryFields = ARCHIVE_FIELDS
 	try:
-		opts, args = getopt.getopt(argv, 'dhvV', ['help', 'debug', 'version'])
+		opts, args = getopt.getopt(argv, 'dhq:vV', ['help', 'debug', 'query=', 'from=', 'to=', 'fields=', 'version'])
 	except getopt.GetoptError:
 		print_help(argv)
 		sys.exit(2)
@@ -484,6 +2469,14 @@ def main(argv):
 			sys.exit(0)
 		elif opt in ('-d', '--debug'):
 			isDebug = True
+		elif opt in ('-q', '--query'):
+			queryStation = arg
+		elif opt == '--from':
+			queryFrom = parseDate(arg)
+		elif opt == '--to':
+			queryTo = parseDate(arg)
+		elif opt == '--fields':
+			queryFields = tuple(arg.split(','))
 		elif opt in ('-v'):
 			isVerbose = True
 		elif opt in ('-V', '--version'):
@@ -492,10 +2485,19 @@ def main(argv):
 
 	if isDebug: print 'Debug is on'
 	global cfg; cfg = load_config()
-
-	if not connected_to_internet():
-		logToDomoticz(MSG_ERROR, 'No internet connection available')
+	if queryStation is not None:
+		if not STATION_ID.match(queryStation):
+			print 'Invalid station ID \'' + queryStation + '\', use letters, digits, _ and - only'
+			sys.exit(2)
+		today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+		printArchive(queryStation, queryFrom or today, queryTo or datetime.utcnow(), queryFields)
 		sys.exit(0)
+	startUpstreams()
+	startSpool()
+	startSinks()
+	startCheckpoint()
+	for stationId in cfg.get('stations', {}):
+		getStation(stationId)
 
 	try:
 		#Create a web server and define the handler to manage the
@@ -504,11 +2506,15 @@ def main(argv):
 			listenPort = cfg['system']['listenPortDebug']
 		else:
 			listenPort = cfg['system']['listenPort']
-		server = HTTPServer(('', listenPort), myHandler)
+		server = ThreadingHTTPServer(('', listenPort), myHandler)
+		signal.signal(signal.SIGTERM, saveCheckpoint)
+		signal.signal(signal.SIGUSR1, startProfile)
+		signal.signal(signal.SIGUSR2, reportMemory)
 		msgProgInfo = PROGRAM_NAME + ' ' + VERSION + ' listening for PWS on port ' + str(listenPort) + '. '
 		msgProgInfo += ' Running on TTY console...' if tty else ' Running as a CRON job...'
-		logToDomoticz(MSG_EXEC, msgProgInfo)
 		if isVerbose: print msgProgInfo
+		# Reports are accepted right away, the connections are checked and Domoticz is told in the background
+		startHealthChecks(msgProgInfo)
 		#Wait forever for incoming htto requests
 		server.serve_forever()
 	except socket.error as msg:
@@ -519,6 +2525,7 @@ def main(argv):
 	except KeyboardInterrupt:
 		print '^C received, shutting down the web server'
 		server.socket.close()
+		saveCheckpoint()
 
 if __name__ == "__main__":
   main(sys.argv[1:])